@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+CSS 709 Bible Translation Analysis
+Utility functions used by Word2Vec_Bible_Analysis.ipynb
+
+"""
+
+# Importing modules
+import re
+import os
+import hashlib
+import itertools
+import multiprocessing
+import numpy as np
+import pandas as pd
+import gensim
+from gensim.utils import simple_preprocess
+
+
+## PREPROCESSING --------------------------------------------------------------------------
+
+# The cleaning steps applied to every line of a text, in order. They are compiled once and
+# applied to one line at a time while the file is read, so the text is never held in memory.
+CLEANING_STEPS = [re.compile(r'<.*?>'), # remove HTML tags - just in case some are missed.
+                  re.compile(r'’s|\'s'), # remove possessive "s"
+                  re.compile(r'\n|\\\\t'), # remove line breaks, tab breaks
+                  re.compile(r'[^\w\s]|_'), # remove punctuation and underscore
+                  re.compile(r'\w*\d\w*'), # remove character strings that contain a digit
+                  re.compile(r'\d')] # remove digits
+
+# custom stopwords, mainly from medieval english, used in addition to the nltk english stopwords
+EXTRA_STOP_WORDS = ['shall', 'unto', 'thou', 'thy', 'ye', 'thee', 'upon', 'shalt', 'hath', 'also', 'us', 'hast', 'thine']
+
+
+# this function cleans a single line of text and splits it into lowercase words
+def clean_line(line):
+    for pattern in CLEANING_STEPS:
+        line = pattern.sub('', line)
+    return line.lower().split()
+
+
+# this function reads a text one line at a time and yields the words of every non-empty line.
+# Use encoding = "utf8" for UTF encoded text and None for the system default encoding.
+def read_sentences(fname, encoding = None):
+    with open(fname, encoding = encoding, newline = '') as f:
+        for line in f:
+            words = clean_line(line)
+            if words != []:
+                yield words
+
+
+# this function removes accents, drops words shorter than 2 or longer than 15 characters
+# and removes the stopwords of a single sentence. stop_words should be a set.
+def tokenize_sentence(words, stop_words):
+    return [word for word in simple_preprocess(' '.join(words), deacc = True) if word not in stop_words]
+
+
+# A corpus of the tokenized sentences of a text, read lazily from the file.
+# Every iteration reads the file again, so gensim can make several passes (one per epoch)
+# while memory stays flat no matter how large the text is.
+class BibleCorpus:
+    def __init__(self, fname, stop_words, encoding = "utf8"):
+        self.fname = fname
+        self.stop_words = set(stop_words)
+        self.encoding = encoding
+
+    def __iter__(self):
+        for words in read_sentences(self.fname, self.encoding):
+            yield tokenize_sentence(words, self.stop_words)
+
+
+## CORPUS CACHE ---------------------------------------------------------------------------
+
+# Cleaned corpora are written once to the cache folder in gensim's LineSentence format (one
+# sentence per line, words separated by spaces), which Word2Vec can read directly through its
+# faster multi-core corpus_file path. The file name is a hash of the source text and every
+# cleaning setting, so a changed text, stopword list or cleaning step never reuses an old corpus.
+CORPUS_CACHE_DIR = "corpus_cache"
+
+# bump this when the cleaning or tokenizing code changes in a way the settings below do not capture
+CLEANING_VERSION = 1
+
+
+# this function returns the cache key of a text cleaned with the given settings
+def corpus_key(fname, stop_words, encoding):
+    file_hash = hashlib.sha256()
+    with open(fname, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            file_hash.update(block)
+    settings = [file_hash.hexdigest(), str(encoding), str(CLEANING_VERSION)]
+    settings.extend(pattern.pattern for pattern in CLEANING_STEPS)
+    settings.extend(sorted(stop_words))
+    return hashlib.sha256("\n".join(settings).encode("utf8")).hexdigest()[:32]
+
+
+# this function returns the path of the cleaned corpus of a text in LineSentence format,
+# cleaning the text and writing the corpus first if the cache does not have it yet
+def cache_corpus(fname, stop_words, encoding = "utf8", cache_dir = CORPUS_CACHE_DIR):
+    corpus_file = os.path.join(cache_dir, corpus_key(fname, stop_words, encoding) + ".txt")
+    if not os.path.exists(corpus_file):
+        os.makedirs(cache_dir, exist_ok = True)
+        # write to a temporary file first, so an interrupted run never leaves a partial corpus behind
+        with open(corpus_file + ".tmp", "w", encoding = "utf8", newline = "\n") as f:
+            for sentence in BibleCorpus(fname, stop_words, encoding):
+                f.write(" ".join(sentence) + "\n")
+        os.replace(corpus_file + ".tmp", corpus_file)
+    return corpus_file
+
+
+## CONCEPT SCORING -----------------------------------------------------------------------
+
+# Pairs of words representing the positive and negative side of a sentiment dimension
+ANCHOR_PAIRS = [('holy', 'evil'), ('good', 'bad'), ('clean', 'unclean')]
+
+
+# this function returns the vectors of the given words from a model's word vectors (model.wv),
+# as a (words, vector size) array with a row of NaN for every word the model does not know
+def word_vectors(wv, words):
+    vectors = np.full((len(words), wv.vector_size), np.nan, dtype = np.float32)
+    for i, word in enumerate(words):
+        if word in wv.key_to_index:
+            vectors[i] = wv[word]
+    return vectors
+
+
+# this function scales every vector (the last axis) to unit length
+def normalize_rows(vectors):
+    return vectors / np.linalg.norm(vectors, axis = -1, keepdims = True)
+
+
+# This function scores concepts against anchor pairs the same way distance_array does:
+# similarity(concept, good word) - similarity(concept, bad word). Since the cosine similarity is the
+# dot product of unit vectors, this is the concept vector times (good vector - bad vector), so all
+# concepts and pairs are scored with a single matrix product.
+# vectors is a (words, vector size) array of one model, or a (models, words, vector size) stack
+# of many; concept_index, good_index and bad_index are the rows of the concepts and of the good
+# and bad word of every pair. Returns a (concepts, pairs) array, or one per model
+def score_concepts(vectors, concept_index, good_index, bad_index):
+    normed = normalize_rows(vectors)
+    directions = normed[..., good_index, :] - normed[..., bad_index, :]
+    return normed[..., concept_index, :] @ np.swapaxes(directions, -1, -2)
+
+
+## ALIGNMENT ------------------------------------------------------------------------------
+
+# Every Word2Vec model places its vectors in its own randomly rotated space, so vectors of different
+# seeds or translations can only be compared directly after rotating them into a common space.
+
+# This function returns the rotation that best maps the rows of source onto the rows of target
+# (orthogonal Procrustes), using the words known to both. Works on stacks of models as well:
+# source and target are (..., words, vector size) arrays and one rotation is returned per model
+def procrustes_rotation(source, target):
+    known = np.isfinite(source).all(axis = -1) & np.isfinite(target).all(axis = -1)
+    source = np.where(known[..., None], normalize_rows(source), 0)
+    target = np.where(known[..., None], normalize_rows(target), 0)
+    u, _, vt = np.linalg.svd(np.swapaxes(source, -1, -2) @ target)
+    return u @ vt
+
+
+# this function returns the mean of unit vectors over the first axis, ignoring unknown words
+def mean_direction(vectors):
+    normed = normalize_rows(vectors)
+    known = np.isfinite(normed)
+    counts = known.sum(axis = 0)
+    total = np.where(known, normed, 0).sum(axis = 0)
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        return np.where(counts > 0, total / counts, np.nan)
+
+
+# This function rotates a (models, words, vector size) stack of vectors into a common space with
+# generalized Procrustes analysis: every model is first aligned to the first model, then
+# repeatedly to the mean of the aligned models. All models are aligned at once.
+# Returns the aligned stack
+def align_ensemble(vectors, iterations = 3):
+    aligned = vectors @ procrustes_rotation(vectors, vectors[0])
+    for i in range(iterations):
+        aligned = vectors @ procrustes_rotation(vectors, mean_direction(aligned))
+    return aligned
+
+
+# This function compares aligned models word by word: it returns a (models, words) array with the
+# similarity of every model's vector of a word to the mean vector of that word over all models.
+# Values close to 1 mean the models agree on where the word lies
+def vector_agreement(aligned):
+    mean = normalize_rows(mean_direction(aligned))
+    return np.sum(normalize_rows(aligned) * mean, axis = -1)
+
+
+## ENSEMBLE TRAINING ----------------------------------------------------------------------
+
+# model params used by the notebook; any of them can be changed per job
+DEFAULT_PARAMS = {"window": 5, "negative": 15, "min_count": 1, "epochs": 20, "vector_size": 100, "sg": 0}
+
+
+# this function trains one model of the ensemble and keeps only what the analysis needs.
+# job is (translation, corpus_file, seed, params, words, threads). Returns the job description
+# and the vectors of the given words (a row of NaN for words the model does not know)
+def train_ensemble_job(job):
+    translation, corpus_file, seed, params, words, threads = job
+    model = gensim.models.Word2Vec(corpus_file = corpus_file, seed = seed, workers = threads, **params)
+    # the model itself is dropped here, only the needed vectors are sent back
+    return translation, seed, params, word_vectors(model.wv, words)
+
+
+# This function trains a Word2Vec model for every (translation, seed, hyperparameter) combination
+# across a pool of worker processes. fnames maps a translation name to its text file (or is a list
+# of files), and param_grid is a list of dictionaries of Word2Vec params that change DEFAULT_PARAMS.
+# Every model uses its seed explicitly; gensim training is only exactly reproducible with a single
+# thread per model (threads = 1) and a fixed PYTHONHASHSEED. By default the pool has one process
+# per `threads` cores of the machine.
+# Returns a list of (translation, seed, params, vectors of words) for every job, in job order
+def train_ensemble(fnames, words, stop_words, seeds = range(10), param_grid = [{}], encoding = "utf8",
+                   processes = None, threads = 1):
+    if not isinstance(fnames, dict):
+        fnames = {os.path.splitext(os.path.basename(fname))[0]: fname for fname in fnames}
+    # clean every translation once, before any model is trained
+    corpus_files = {translation: cache_corpus(fname, stop_words, encoding) for translation, fname in fnames.items()}
+    jobs = [(translation, corpus_files[translation], seed, dict(DEFAULT_PARAMS, **params), list(words), threads)
+            for translation, seed, params in itertools.product(fnames, seeds, param_grid)]
+    if processes is None:
+        processes = max(1, (os.cpu_count() or 1) // threads)
+    with multiprocessing.Pool(processes) as pool:
+        return list(pool.imap(train_ensemble_job, jobs))
+
+
+# This function scores the concepts of every trained model against every anchor pair at once
+# (see score_concepts). Returns a tidy table with one row per model, concept and anchor pair
+def score_ensemble(results, words, concepts, anchor_pairs):
+    position = {word: i for i, word in enumerate(words)}
+    vectors = np.stack([result[3] for result in results])
+    scores = score_concepts(vectors, [position[word] for word in concepts],
+                            [position[good] for good, bad in anchor_pairs], [position[bad] for good, bad in anchor_pairs])
+    # one row per model, repeated for every concept and pair
+    jobs = pd.DataFrame([dict({"translation": translation, "seed": seed}, **params) for translation, seed, params, v in results])
+    table = jobs.loc[jobs.index.repeat(len(concepts) * len(anchor_pairs))].reset_index(drop = True)
+    table["concept"] = np.tile(np.repeat(list(concepts), len(anchor_pairs)), len(results))
+    table["anchor"] = np.tile(["%s/%s" % pair for pair in anchor_pairs], len(results) * len(concepts))
+    table["score"] = scores.ravel()
+    return table
+
+
+# This function trains the ensemble (see train_ensemble) and scores the concepts of every model the
+# same way distance_array does, against good_word/bad_word and any further anchor_pairs.
+# align_words lists extra words to keep from every model, e.g. for aligning them with align_ensemble.
+# Returns a tidy table with one row per model, concept and anchor pair, a summary table with the
+# mean and variance of every concept per translation, params and anchor pair, and the list of
+# trained results; both tables are written to out_file (as out_file and out_file with _summary
+# added) when it is given.
+def run_ensemble(fnames, concepts, good_word, bad_word, stop_words, seeds = range(10), param_grid = [{}],
+                 encoding = "utf8", processes = None, threads = 1, out_file = None, anchor_pairs = (), align_words = ()):
+    anchor_pairs = [(good_word, bad_word)] + [pair for pair in anchor_pairs if pair != (good_word, bad_word)]
+    words = list(dict.fromkeys(list(concepts) + [word for pair in anchor_pairs for word in pair] + list(align_words)))
+    results = train_ensemble(fnames, words, stop_words, seeds, param_grid, encoding, processes, threads)
+    table = score_ensemble(results, words, concepts, anchor_pairs)
+    param_names = list(dict.fromkeys(name for result in results for name in result[2]))
+    groups = ["translation"] + param_names + ["anchor", "concept"]
+    summary = table.groupby(groups, sort = False)["score"].agg(["mean", "var"]).reset_index()
+    if out_file is not None:
+        table.to_csv(out_file, index = False)
+        summary.to_csv(os.path.splitext(out_file)[0] + "_summary.csv", index = False)
+    return table, summary, results
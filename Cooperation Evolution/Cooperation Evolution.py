@@ -8,199 +8,1160 @@ Created on Fri Nov 26 22:12:37 2021
 import numpy as np
 import random
 import copy
+import itertools
+import json
+import multiprocessing
+import os
+import time
+import zlib
 import pandas as pd
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError: # Parquet output is optional, CSV is always available
+    pq = None
 
 rewardPayoff = 5
 temptationPayoff = 0
 suckerPayoff = -5
 punishmentPayoff = 0
-IDSequence = 0
+
+## GROUP TOPOLOGY -------------------------------------------------------------------
+
+# Which groups meet which, as a sparse adjacency list in CSR form: members of group g play
+# against members of the groups indices[indptr[g]:indptr[g + 1]], listed in increasing order.
+# A group that plays within itself lists its own id. The work per generation grows with the
+# number of listed pairs, not with the square of the number of groups
+class groupTopology():
+
+    def __init__(self, indptr, indices, name="custom"):
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.name = name
+        self.numGroups = len(self.indptr) - 1
+        # plain lists for the agent model, which walks them one agent at a time
+        self.neighborLists = [self.indices[self.indptr[g]:self.indptr[g + 1]].tolist() for g in range(self.numGroups)]
+
+    def __str__(self):
+        return self.name
+
+    # The name followed by a checksum of the pairs, so that different topologies given the same
+    # name (every custom one) never share a key
+    def key(self):
+        return "{0}-{1:08x}".format(self.name, zlib.crc32(self.indptr.tobytes() + self.indices.tobytes()))
+
+    # number of groups each group meets
+    def degrees(self):
+        return np.diff(self.indptr)
+
+    # the group on the playing side of every pair, in the same order as indices
+    def sources(self):
+        return np.repeat(np.arange(self.numGroups), self.degrees())
+
+# Build a topology from (group, group) pairs. Pairs work both ways unless directed is True,
+# and every group plays within itself unless selfInteraction is False
+def TopologyFromPairs(numGroups, pairs, selfInteraction=True, directed=False, name="custom"):
+    pairs = np.array(list(pairs), dtype=np.int64).reshape(-1, 2)
+    if not directed:
+        pairs = np.vstack([pairs, pairs[:, ::-1]])
+    if selfInteraction:
+        pairs = np.vstack([pairs, np.repeat(np.arange(numGroups), 2).reshape(-1, 2)])
+    # sort the pairs by group and drop duplicates
+    pairs = np.unique(pairs, axis=0)
+    indptr = np.searchsorted(pairs[:, 0], np.arange(numGroups + 1))
+    return groupTopology(indptr, pairs[:, 1], name)
+
+# Every group meets every group, including itself. With two groups this is the original model
+def CompleteTopology(numGroups):
+    return TopologyFromPairs(numGroups, itertools.combinations(range(numGroups), 2), name="complete")
+
+# Groups arranged in a ring, each meeting itself and the groups within reach on either side
+def RingTopology(numGroups, reach=1):
+    pairs = [(g, (g + offset) % numGroups) for g in range(numGroups) for offset in range(1, reach + 1)]
+    return TopologyFromPairs(numGroups, pairs, name="ring{0}".format(reach))
+
+# Each pair of different groups meets with probability p; every group meets itself
+def RandomTopology(numGroups, p, seed=None):
+    first, second = np.triu_indices(numGroups, k=1)
+    meets = np.random.default_rng(seed).random(len(first)) < p
+    return TopologyFromPairs(numGroups, zip(first[meets], second[meets]), name="random{0}-{1}".format(p, seed))
+
+## MODEL SETTINGS ---------------------------------------------------------------------
+
+# Parameters of a single run, along with the ID counter of that run. Every run (or sweep job)
+# gets its own settings object, so runs never share a counter
+class modelSettings():
+
+    def __init__(self, rewardPayoff=rewardPayoff, temptationPayoff=temptationPayoff,
+                 suckerPayoff=suckerPayoff, punishmentPayoff=punishmentPayoff,
+                 groupSize=50, sampleSize=20, cullSize=20, mutationRate=0.001,
+                 selection="proportional", selectionParameter=None, numGroups=None, topology=None):
+        self.rewardPayoff = rewardPayoff
+        self.temptationPayoff = temptationPayoff
+        self.suckerPayoff = suckerPayoff
+        self.punishmentPayoff = punishmentPayoff
+        self.groupSize = groupSize
+        self.sampleSize = sampleSize
+        self.cullSize = cullSize
+        self.mutationRate = mutationRate
+        # name of the scheme in selectionSchemes used to pick parents, and its parameter
+        # (None uses the scheme's default)
+        self.selection = selection
+        self.selectionParameter = selectionParameter
+        # which groups meet; without a topology there are two groups (or numGroups) that all meet
+        if topology is None:
+            topology = CompleteTopology(2 if numGroups is None else numGroups)
+        elif numGroups is not None and numGroups != topology.numGroups:
+            raise ValueError("numGroups does not match the topology")
+        self.topology = topology
+        self.numGroups = topology.numGroups
+        self.IDSequence = 0
+
+    def __str__(self):
+        return "R: {0}, T: {1}, S: {2}, P: {3}, Group: {4}, Sample: {5}, Cull: {6}, Mutation: {7}, Selection: {8} ({9}), Groups: {10} ({11})".format(
+            self.rewardPayoff, self.temptationPayoff, self.suckerPayoff, self.punishmentPayoff,
+            self.groupSize, self.sampleSize, self.cullSize, self.mutationRate,
+            self.selection, self.selectionParameter, self.numGroups, self.topology)
+
+    def nextID(self):
+        self.IDSequence += 1
+        return self.IDSequence - 1
+
+defaultSettings = modelSettings()
+
+## AGENT MODEL ------------------------------------------------------------------------
 
 class agent():
-    agentID = 0
-    YChromosome = [0, 0, 0, 0]
-    GChromosome = [0, 0, 0, 0]
-    score = 0.0
-    socksColor = ""
-    choice = 0
+    __slots__ = ("agentID", "chromosome", "score", "group", "choice", "cooperations")
     
-    def __init__(self, agentID, YChromosome, GChromosome, score, socksColor, choice):
+    # chromosome holds one 4-bit strategy (0 to 15) per group, packed into a uint8: entry h is used
+    # when playing against group h. Bit 3 is the first chromosome bit, with weight 8, down to bit 0
+    def __init__(self, agentID, chromosome, score, group, choice):
         self.agentID = agentID
-        self.YChromosome = YChromosome
-        self.GChromosome = GChromosome
+        self.chromosome = chromosome
         self.score = score
-        self.socksColor = socksColor
+        self.group = group
         self.choice = choice
+        # number of times the agent cooperated with each group it meets in its last step,
+        # in the order the topology lists them
+        self.cooperations = []
     
     def __str__(self):
-        return "ID: {0}, Y: {1}, G: {2}, Score: {3}, Group: {4}, Choice: {5}".format(self.agentID,
-            self.YChromosome, self.GChromosome, self.score, self.socksColor, self.choice)
+        return "ID: {0}, Chromosome: {1}, Score: {2}, Group: {3}, Choice: {4}".format(self.agentID,
+            self.chromosome.tolist(), self.score, self.group, self.choice)
         
     def reset(self):
         self.score = 0.0
+
+    # Copy of this agent under a new ID. Only the chromosome and counts need copying, everything else is immutable
+    def clone(self, agentID):
+        child = agent(agentID, self.chromosome.copy(), self.score, self.group, self.choice)
+        child.cooperations = self.cooperations[:]
+        return child
         
     
-def SetupAgents(yellowGroup, greenGroup):
-    global IDSequence
-    for i in range(50):
-        tempYChromosome = []
-        tempGChromosome = []
-        for j in range(4):
-            tempYChromosome.append(random.randint(0,1))
-            tempGChromosome.append(random.randint(0,1))
-        tempAgent = agent(IDSequence, tempYChromosome, tempGChromosome, 0.0, "yellow", random.randint(0, 1))
-        yellowGroup.append(tempAgent)
-        IDSequence += 1
-    for i in range(50):
-        tempYChromosome = []
-        tempGChromosome = []
-        for j in range(4):
-            tempYChromosome.append(random.randint(0,1))
-            tempGChromosome.append(random.randint(0,1))
-        tempAgent = agent(IDSequence, tempYChromosome, tempGChromosome, 0.0, "green", random.randint(0, 1))
-        greenGroup.append(tempAgent)
-        IDSequence += 1
+# Fill groups with settings.numGroups lists of settings.groupSize agents with random chromosomes
+def SetupAgents(groups, settings=defaultSettings):
+    for group in range(settings.numGroups):
+        tempGroup = []
+        for i in range(settings.groupSize):
+            tempChromosome = np.random.randint(0, 16, size=settings.numGroups).astype(np.uint8)
+            tempAgent = agent(settings.nextID(), tempChromosome, 0.0, group, random.randint(0, 1))
+            tempGroup.append(tempAgent)
+        groups.append(tempGroup)
       
         
-# Shuffle the group to avoid repeating sequences. Call each agent to perform their steps.
-# Based on the scores, cull the worst performing agents and breed new ones to take their place 
-def ModelStep(yellowGroup, greenGroup):
-    np.random.shuffle(yellowGroup)
-    np.random.shuffle(greenGroup)
-    for agent in yellowGroup:
-        AgentStep(agent, yellowGroup, greenGroup)
-    for agent in greenGroup:
-        AgentStep(agent, yellowGroup, greenGroup)
-    # print("before: ", len(yellowGroup))
-    CullAgents(yellowGroup)
-    # print("culled: ", len(yellowGroup))
-    CullAgents(greenGroup)
-    BreedAgents(yellowGroup)
-    # print("born: ", len(yellowGroup))
-    BreedAgents(greenGroup)
+# Shuffle the groups to avoid repeating sequences. Call each agent to perform their steps.
+# Based on the scores, cull the worst performing agents and breed new ones to take their place.
+# With a phaseTimer, the step is timed phase by phase instead (see TimedModelStep)
+def ModelStep(groups, settings=defaultSettings, timer=None):
+    if timer is not None:
+        return TimedModelStep(groups, settings, timer)
+    for group in groups:
+        np.random.shuffle(group)
+    for group in groups:
+        for index, agent in enumerate(group):
+            AgentStep(agent, index, groups, settings)
+    for group in groups:
+        CullAgents(group, settings)
+    for group in groups:
+        BreedAgents(group, settings)
     
-# For each agent, interact with 25 other agents from each group        
-def AgentStep(agent, yellowGroup, greenGroup):
-    # First, create a temp group that does not contain our agent
-    tempYellow = []
-    tempGreen = []
+# Sample k positions out of a group of groupLength agents, leaving out the agent at selfIndex.
+# Positions are drawn from a group one shorter, and every position at or after the agent's own
+# is moved up by one, so the group never has to be copied
+def SampleOthers(groupLength, selfIndex, k):
+    return [index + (index >= selfIndex) for index in random.sample(range(groupLength - 1), k)]
+
+# For each agent, interact with 20 other agents from every group its group meets.
+# agentIndex is the agent's position in its own group, which is left out of the sample
+def AgentStep(agent, agentIndex, groups, settings=defaultSettings):
     agent.score = 0
-    for tempAgent in yellowGroup:
-        if tempAgent.agentID != agent.agentID:
-            tempYellow.append(tempAgent)
-    for tempAgent in greenGroup:
-        if tempAgent.agentID != agent.agentID:
-            tempGreen.append(tempAgent)
-    # Now, interact with 40 randomly sampled agents from each group
-    if agent.socksColor == "yellow":          
-        for opponent in random.sample(tempYellow, 20): # return 40 samples from our 50 agent set
-            Interact(agent, opponent)
-        for opponent in random.sample(tempGreen, 20): # return 40 samples from our 50 agent set
-            Interact(agent, opponent)
-    if agent.socksColor == "green":          
-        for opponent in random.sample(tempYellow, 20): # return 40 samples from our 50 agent set
-            Interact(agent, opponent)
-        for opponent in random.sample(tempGreen, 20): # return 40 samples from our 50 agent set
-            Interact(agent, opponent)
+    neighbors = settings.topology.neighborLists[agent.group]
+    agent.cooperations = [0] * len(neighbors)
+    for position, opponentGroup in enumerate(neighbors):
+        # Pick 20 opponents from the group by their position, skipping our own agent
+        if opponentGroup == agent.group:
+            picks = SampleOthers(len(groups[opponentGroup]), agentIndex, settings.sampleSize)
+        else:
+            picks = random.sample(range(len(groups[opponentGroup])), settings.sampleSize)
+        # Now, interact with the sampled agents
+        for index in picks:
+            Interact(agent, groups[opponentGroup][index], settings)
+            agent.cooperations[position] += agent.choice
     
 # Interact with another agent and increment score based on the interaction
-def Interact(agent, opponent): 
+def Interact(agent, opponent, settings=defaultSettings): 
     SelectChoice(agent, opponent)
     SelectChoice(opponent, agent)
     if opponent.choice == 1:
         if agent.choice == 1:
-            agent.score = agent.score + rewardPayoff
+            agent.score = agent.score + settings.rewardPayoff
         elif agent.choice == 0:
-            agent.score = agent.score + temptationPayoff
+            agent.score = agent.score + settings.temptationPayoff
     elif opponent.choice == 0:
         if agent.choice == 1:
-            agent.score = agent.score + suckerPayoff
+            agent.score = agent.score + settings.suckerPayoff
         elif agent.choice == 0:
-            agent.score = agent.score + punishmentPayoff
+            agent.score = agent.score + settings.punishmentPayoff
         
-# Return agent's choice weighted baed on their Chromosomes 
+# Return agent's choice weighted baed on their chromosome for the opponent's group.
+# Picking a bit with weights [8, 4, 2, 1] cooperates with probability strategy / 15
 def SelectChoice(agent, opponent):
-    if opponent.socksColor == "yellow":
-        agent.choice = random.choices(agent.YChromosome, weights = [8, 4, 2, 1])[0]
-    elif opponent.socksColor == "green":
-        agent.choice = random.choices(agent.GChromosome, weights = [8, 4, 2, 1])[0]
+    agent.choice = int(random.random() * maxStrategy < agent.chromosome[opponent.group])
  
 # Sort agents in a group by score, and prune 20 lowest scores
-def CullAgents(group):
+def CullAgents(group, settings=defaultSettings):
 
     group.sort(key=lambda x: x.score)
 #    print("BEFORE")
 #    for x in group:
 #        print(x)
-    del group[:20]
+    del group[:settings.cullSize]
 #    print("AFTER")
 #    for x in group:
 #        print(x)
 #    print("OK")
     
 # Create 20 new agents for each group, mutate them and append to the original group
-def BreedAgents(group):
-    global IDSequence
-    tempWeights = []
-    # generate the weights based on agent's score
-    for agent in group:
-        tempWeights.append(agent.score)
-    # create 20 new agent copies proportional to the "score" from the original group
-    tempGroup = []
+def BreedAgents(group, settings=defaultSettings):
+    children = BreedChildren(group, settings)
+    MutateChildren(children, settings)
+    group.extend(children)
 
+# Pick the parents of all 20 new agents in one draw, based on the "score" from the original group.
+# Each child only copies its parent's chromosomes and gets a new ID
+def BreedChildren(group, settings=defaultSettings):
+    scores = np.fromiter((agent.score for agent in group), dtype=float, count=len(group))
+    parents = SelectParents(scores, settings.cullSize, np.random, settings)
+    return [group[parentIndex].clone(settings.nextID()) for parentIndex in parents]
 
-    for i in range(20):
-        tempAgentList = copy.deepcopy(random.choices(group, weights = tempWeights, k=1)) 
-        # Give the agent a new ID
+# Mutate all children at once: site k is bit k % 4 of strategy k // 4, children one after another.
+# Returns the number of bits flipped
+def MutateChildren(children, settings=defaultSettings):
+    bitsPerAgent = 4 * settings.numGroups
+    sites = MutationSites(np.random, len(children) * bitsPerAgent, settings.mutationRate)
+    for site in sites:
+        child = children[site // bitsPerAgent]
+        child.chromosome[(site % bitsPerAgent) // 4] ^= 1 << (site % 4)
+    return len(sites)
 
-        tempAgentList[0].agentID = IDSequence 
-        IDSequence += 1
-        Mutate(tempAgentList[0])
-        tempGroup.extend(tempAgentList)
+# Positions of the bits to flip out of numBits bits, each flipped with a probability of mutationRate.
+# Instead of drawing a number per bit, the gaps between flips are drawn from a geometric
+# distribution, so the cost grows with the number of mutations rather than the number of bits.
+# rng is either np.random or a np.random.Generator
+def MutationSites(rng, numBits, mutationRate):
+    if mutationRate <= 0 or numBits == 0:
+        return np.empty(0, dtype=np.int64)
+    # enough gaps to cover all bits most of the time; any shortfall is drawn in another round
+    expected = numBits * mutationRate
+    chunk = int(expected + 4 * np.sqrt(expected)) + 1
+    sites = []
+    last = -1
+    while last < numBits:
+        steps = last + np.cumsum(rng.geometric(mutationRate, size=chunk))
+        sites.append(steps[steps < numBits])
+        last = steps[-1]
+    return np.concatenate(sites)
 
-    group.extend(tempGroup)
-    
 # Flip the Chromosome bit with a probability of 0.1% each bit
 # This means that there is a 99.2% chance that no bit will be mutated   
-def Mutate(agent): 
+def Mutate(agent, settings=defaultSettings): 
 
-    for index, value in enumerate(agent.YChromosome):
-        if random.random() > 0.999:
-            agent.YChromosome[index] = 1 - agent.YChromosome[index]
-    for index, value in enumerate(agent.GChromosome):
-        if random.random() > 0.999:
-            agent.GChromosome[index] = 1 - agent.GChromosome[index]
+    for site in MutationSites(np.random, 4 * len(agent.chromosome), settings.mutationRate):
+        agent.chromosome[site // 4] ^= 1 << (site % 4)
 
             
-# MAIN FUNCTION THAT CALLS OTHERS    
-def MainSim():
-
-
-    outputDF = pd.DataFrame({'yellows_yellow': [],
-                           'yellows_green': [], 
-                           'greens_yellow': [], 
-                           'greens_green': []})
-    for j in range (1):
-        yellowGroup = []
-        greenGroup = []
-        SetupAgents(yellowGroup, greenGroup)
-        for i in range (1000):
-            ModelStep(yellowGroup, greenGroup)
-            yellowsYellow = 0
-            yellowsGreen = 0
-            greensYellow = 0
-            greensGreen = 0
-            for x in yellowGroup:
-                yellowsYellow = yellowsYellow + x.YChromosome[0]*8 + x.YChromosome[1]*4 +  + x.YChromosome[2]*2 +  + x.YChromosome[3]
-                yellowsGreen = yellowsGreen + x.GChromosome[0]*8 + x.GChromosome[1]*4 +  + x.GChromosome[2]*2 +  + x.GChromosome[3]
-            for x in greenGroup:
-                greensYellow = greensYellow + x.YChromosome[0]*8 + x.YChromosome[1]*4 +  + x.YChromosome[2]*2 +  + x.YChromosome[3]
-                greensGreen = greensGreen + x.GChromosome[0]*8 + x.GChromosome[1]*4 +  + x.GChromosome[2]*2 +  + x.GChromosome[3]
-            outputDF.loc[len(outputDF.index)] = [yellowsYellow*100/(15*50), yellowsGreen*100/(15*50), greensYellow*100/(15*50), greensGreen*100/(15*50)]
+## SELECTION ------------------------------------------------------------------------
+
+# Every scheme takes the scores of the candidate parents and returns the positions of k parents,
+# all drawn at once. rng is either np.random or a np.random.Generator; only rng.random is used.
+# Drawing from cumulative weights costs one pass over the scores plus O(log n) per parent, and
+# tournaments do not look at the whole population at all, so selection stays cheap for millions of agents
+
+# Draw k positions with probability proportional to the (non-negative) weights
+def WeightedDraw(weights, k, rng):
+    cumWeights = np.cumsum(weights)
+    if cumWeights[-1] <= 0:
+        # nobody has any weight, so everyone is equally likely
+        return np.floor(rng.random(k) * len(weights)).astype(np.int64)
+    draws = np.searchsorted(cumWeights, rng.random(k) * cumWeights[-1], side="right")
+    return np.minimum(draws, len(weights) - 1)
+
+# Fitness proportional selection. Scores are shifted up when the lowest one is negative, so
+# negative payoffs never produce negative weights; non-negative scores are used as they are
+def ProportionalSelection(scores, k, rng, parameter=None):
+    return WeightedDraw(scores - min(scores.min(), 0.0), k, rng)
 
+# Softmax (Boltzmann) selection, with the parameter as temperature. Lower temperatures favor
+# the best agents more strongly
+def SoftmaxSelection(scores, k, rng, parameter=None):
+    temperature = 10.0 if parameter is None else parameter
+    return WeightedDraw(np.exp((scores - scores.max()) / temperature), k, rng)
 
+# Tournament selection: every parent is the best of the parameter (default 3) agents picked at random
+def TournamentSelection(scores, k, rng, parameter=None):
+    size = 3 if parameter is None else int(parameter)
+    entrants = np.floor(rng.random((k, size)) * len(scores)).astype(np.int64)
+    return entrants[np.arange(k), np.argmax(scores[entrants], axis=1)]
+
+# Truncation selection: parents are picked uniformly from the best fraction (default 0.5) of agents
+def TruncationSelection(scores, k, rng, parameter=None):
+    fraction = 0.5 if parameter is None else parameter
+    top = max(1, int(np.ceil(fraction * len(scores))))
+    best = np.argpartition(scores, len(scores) - top)[len(scores) - top:]
+    return best[np.floor(rng.random(k) * top).astype(np.int64)]
+
+selectionSchemes = {"proportional": ProportionalSelection,
+                    "softmax": SoftmaxSelection,
+                    "tournament": TournamentSelection,
+                    "truncation": TruncationSelection}
+
+# Pick k parents with the selection scheme of the settings
+def SelectParents(scores, k, rng, settings=defaultSettings):
+    return selectionSchemes[settings.selection](scores, k, rng, settings.selectionParameter)
+
+# Run one replicate of the model and return its output, one row per recorded generation.
+# Without a recorder, the strategy percentages of every generation are kept in memory
+# With a checkpointFile, the run is saved there every checkpointEvery generations, and a run
+# started with an existing checkpointFile carries on from it instead of starting over.
+# With a phaseTimer, the time spent in every phase of every generation is logged to it
+def RunReplicate(settings=defaultSettings, generations=1000, recorder=None, checkpointFile=None, checkpointEvery=1000, timer=None):
+    if recorder is None:
+        recorder = DefaultRecorder(settings=settings)
+    if checkpointFile is not None and os.path.exists(checkpointFile):
+        start, settings, groups = LoadCheckpoint(checkpointFile, recorder)
+    else:
+        start = 0
+        groups = []
+        SetupAgents(groups, settings)
+    for i in range (start, generations):
+        ModelStep(groups, settings, timer)
+        if recorder.due(i + 1):
+            recorder.record(i + 1, AgentsToPopulation(groups, settings))
+            if timer is not None:
+                timer.lap("metrics")
+        if checkpointFile is not None and (i + 1) % checkpointEvery == 0:
+            SaveCheckpoint(checkpointFile, i + 1, settings, groups, recorder)
+            if timer is not None:
+                timer.lap("checkpoint")
+        if timer is not None:
+            timer.endGeneration(i + 1)
+    return recorder.result()
+            
+# MAIN FUNCTION THAT CALLS OTHERS    
+# With a timingFile, the per-phase timings of every generation are written there as well
+def MainSim(settings=defaultSettings, replicates=1, generations=1000, outFile="one_run.csv", every=1, timingFile=None):
+
+    runs = []
+    timings = []
+    for j in range (replicates):
+        timer = None if timingFile is None else phaseTimer()
+        runs.append(RunReplicate(settings, generations, DefaultRecorder(every=every, settings=settings), timer=timer))
+        if timer is not None:
+            timings.append(timer.result(replicate=j))
         print(j)
-    outputDF.to_csv("one_run.csv")
+    outputDF = pd.concat(runs, ignore_index=True)
+    outputDF.to_csv(outFile)
+    if timingFile is not None:
+        pd.concat(timings, ignore_index=True).to_csv(timingFile, index=False)
     print("done!")
-    
-MainSim()
+    return outputDF
+
+############################ VECTORIZED POPULATION ENGINE ############################
+
+# The engine below runs the same model as ModelStep, but holds the whole population as arrays
+# instead of agent objects, so that every game in a generation is played in a few batched
+# array operations.
+
+# Largest strategy a 4-bit chromosome can hold; an agent cooperates with probability strategy / maxStrategy
+maxStrategy = 15
+
+# Payoff of an interaction for the agent, indexed as [agent choice][opponent choice]
+def PayoffMatrix(settings=defaultSettings):
+    return np.array([[settings.punishmentPayoff, settings.temptationPayoff],
+                     [settings.suckerPayoff, settings.rewardPayoff]], dtype=float)
+
+# The contacts of a population: one row for every (agent, group it meets) pair, agent by agent,
+# in the order of the topology. Returns where each agent's rows start, the agent of each row
+# and the topology pair (position in topology.indices) of each row
+def ContactRows(groups, topology):
+    counts = topology.degrees()[groups]
+    contactStarts = np.concatenate([[0], np.cumsum(counts)])
+    contactAgents = np.repeat(np.arange(len(groups)), counts)
+    contactPairs = np.repeat(topology.indptr[groups] - contactStarts[:-1], counts) + np.arange(contactStarts[-1])
+    return contactStarts, contactAgents, contactPairs
+
+class population():
+    # chromosomes: (N, groups) uint8 matrix of packed 4-bit strategies, entry h of an agent is its
+    # chromosome against group h (see agent)
+    # scores, groups, agentIDs: one entry per agent
+    # Agents of the same group occupy one contiguous block of rows, which never changes size:
+    # group g holds rows groupStarts[g] to groupStarts[g + 1]
+    # cooperations: one entry per contact (see ContactRows), the number of times the agent
+    # cooperated with that group in the last generation, out of sampleSize games
+    def __init__(self, chromosomes, scores, groups, agentIDs, IDSequence, topology):
+        self.chromosomes = chromosomes
+        self.scores = scores
+        self.groups = groups
+        self.agentIDs = agentIDs
+        self.IDSequence = IDSequence
+        self.topology = topology
+        self.groupStarts = np.searchsorted(groups, np.arange(topology.numGroups + 1))
+        self.contactStarts, self.contactAgents, self.contactPairs = ContactRows(groups, topology)
+        self.cooperations = np.zeros(len(self.contactAgents), dtype=np.int64)
+        self.sampleSize = 0
+
+    def __len__(self):
+        return len(self.scores)
+
+    def groupSlice(self, group):
+        return slice(self.groupStarts[group], self.groupStarts[group + 1])
+
+    def groupSizes(self):
+        return np.diff(self.groupStarts)
+
+    # strategy (chromosome value, 0 to 15) of every contact towards the group it meets
+    def contactStrategies(self):
+        targets = self.topology.indices[self.contactPairs]
+        return self.chromosomes[self.contactAgents, targets]
+
+# Create a population of settings.numGroups groups with random chromosomes, same as SetupAgents
+def SetupPopulation(rng, settings=defaultSettings):
+    size = settings.groupSize * settings.numGroups
+    chromosomes = rng.integers(0, 16, size=(size, settings.numGroups), dtype=np.uint8)
+    groups = np.repeat(np.arange(settings.numGroups), settings.groupSize)
+    return population(chromosomes, np.zeros(size), groups, np.arange(size), size, settings.topology)
+
+# Copy the agents of the agent model into a population, so the same statistics can be used for both.
+# Agents that have not played yet (right after SetupAgents) count zero cooperations, like a new population
+def AgentsToPopulation(groups, settings=defaultSettings):
+    agents = [x for group in groups for x in group]
+    chromosomes = np.stack([x.chromosome for x in agents])
+    groupIDs = np.repeat(np.arange(len(groups)), [len(group) for group in groups])
+    pop = population(chromosomes, np.array([x.score for x in agents], dtype=float), groupIDs,
+                     np.array([x.agentID for x in agents]), settings.IDSequence, settings.topology)
+    degrees = settings.topology.degrees()
+    pop.cooperations = np.fromiter(itertools.chain.from_iterable(x.cooperations or [0] * degrees[x.group] for x in agents),
+                                   dtype=np.int64, count=len(pop.contactAgents))
+    pop.sampleSize = settings.sampleSize if any(x.cooperations for x in agents) else 0
+    return pop
+
+# Draw sampleSize distinct opponents for every row, out of a pool of poolSizes[row] agents.
+# selfIndex[row] is the agent's own position in the pool, which is left out, like in SampleOthers;
+# pass the pool size (or leave it out) when the agent is not part of the pool.
+# Rows are first drawn with replacement, which for large pools almost never repeats an opponent;
+# any row that does contain a repeat is redrawn with Robert Floyd's algorithm, run across
+# all those rows at once. Both paths give every subset the same probability
+def SampleOpponents(rng, poolSizes, sampleSize, selfIndex=None):
+    if selfIndex is None:
+        selfIndex = poolSizes
+    available = poolSizes - (selfIndex < poolSizes)
+    if (sampleSize > available).any():
+        raise ValueError("Sample larger than population")
+    # a single bound is much faster to draw with, and is the usual case of equal sized groups
+    high = available[0] if (available == available[0]).all() else available[:, None]
+    picks = rng.integers(0, high, size=(len(poolSizes), sampleSize))
+    sortedPicks = np.sort(picks, axis=1)
+    repeats = np.flatnonzero((sortedPicks[:, 1:] == sortedPicks[:, :-1]).any(axis=1))
+    if len(repeats) > 0:
+        redraw = np.empty((len(repeats), sampleSize), dtype=picks.dtype)
+        for k in range(sampleSize):
+            j = available[repeats] - sampleSize + k
+            candidate = rng.integers(0, j + 1)
+            taken = (redraw[:, :k] == candidate[:, None]).any(axis=1)
+            redraw[:, k] = np.where(taken, j, candidate)
+        picks[repeats] = redraw
+    # shift every pick at or above the agent's own position up by one to skip it
+    picks += picks >= selfIndex[:, None]
+    return picks
+
+# Every agent plays sampleSize games against each group it meets and collects its payoff, like
+# AgentStep. All contacts of the population are played at once.
+# Picking a bit with weights [8, 4, 2, 1] means an agent cooperates with probability
+# (8*b0 + 4*b1 + 2*b2 + b3) / 15, so each choice is drawn as a single Bernoulli trial.
+# The payoff of a game is P + (T-P)*opponent + (S-P)*agent + (R-S-T+P)*agent*opponent,
+# so only the per-contact counts of each kind of choice are needed to total the score.
+# Most of the time of a generation goes to SampleOpponents and the random draws below (see the README)
+def PlayGeneration(pop, rng, sampleSize, payoffMatrix):
+    (punishment, temptation), (sucker, reward) = payoffMatrix
+    agents = pop.contactAgents
+    agentGroups = pop.groups[agents]
+    targets = pop.topology.indices[pop.contactPairs]
+    poolSizes = pop.groupSizes()[targets]
+    selfIndex = np.where(targets == agentGroups, agents - pop.groupStarts[agentGroups], poolSizes)
+    picks = pop.groupStarts[targets, None] + SampleOpponents(rng, poolSizes, sampleSize, selfIndex)
+    # cooperation probability of every agent against every group, looked up for both sides
+    probabilities = (pop.chromosomes / np.float32(maxStrategy)).ravel()
+    numGroups = pop.topology.numGroups
+    agentProb = probabilities[agents * numGroups + targets]
+    opponentProb = probabilities[picks * numGroups + agentGroups[:, None]]
+    agentChoice = rng.random(picks.shape, dtype=np.float32) < agentProb[:, None]
+    opponentChoice = rng.random(picks.shape, dtype=np.float32) < opponentProb
+    agentCooperations = np.count_nonzero(agentChoice, axis=1)
+    contactScores = (sampleSize * punishment
+                     + (temptation - punishment) * np.count_nonzero(opponentChoice, axis=1)
+                     + (sucker - punishment) * agentCooperations
+                     + (reward - sucker - temptation + punishment) * np.count_nonzero(agentChoice & opponentChoice, axis=1))
+    pop.scores = np.bincount(agents, weights=contactScores, minlength=len(pop))
+    pop.cooperations = agentCooperations
+    pop.sampleSize = sampleSize
+
+# Replace the cullSize lowest scoring agents of every group with mutated copies of the survivors,
+# picked by the selection scheme of the settings. Ties are broken randomly, which is what the
+# shuffle before the sort achieves in ModelStep
+def CullAndBreed(pop, rng, settings=defaultSettings):
+    cullSize = settings.cullSize
+    degrees = pop.topology.degrees()
+    for group in range(pop.topology.numGroups):
+        members = pop.groupSlice(group)
+        scores = pop.scores[members]
+        order = members.start + np.lexsort((rng.random(len(scores)), scores))
+        culled = order[:cullSize]
+        survivors = order[cullSize:]
+        parents = survivors[SelectParents(pop.scores[survivors], cullSize, rng, settings)]
+        pop.chromosomes[culled] = pop.chromosomes[parents]
+        pop.scores[culled] = pop.scores[parents]
+        contacts = np.arange(degrees[group])
+        pop.cooperations[pop.contactStarts[culled, None] + contacts] = pop.cooperations[pop.contactStarts[parents, None] + contacts]
+        pop.agentIDs[culled] = np.arange(pop.IDSequence, pop.IDSequence + cullSize)
+        pop.IDSequence += cullSize
+        MutatePopulation(pop, rng, culled, settings.mutationRate)
+
+# Flip each chromosome bit of the given agents with a probability of mutationRate, by XORing
+# the strategies at the sites picked by MutationSites
+def MutatePopulation(pop, rng, rows, mutationRate):
+    numGroups = pop.topology.numGroups
+    sites = MutationSites(rng, len(rows) * numGroups * 4, mutationRate)
+    strategies = sites // 4
+    np.bitwise_xor.at(pop.chromosomes, (rows[strategies // numGroups], strategies % numGroups),
+                      (1 << (sites % 4)).astype(np.uint8))
+
+# Array version of ModelStep: play, cull and breed every group
+def PopulationStep(pop, rng, settings=defaultSettings, timer=None):
+    if timer is not None:
+        return TimedPopulationStep(pop, rng, settings, timer)
+    PlayGeneration(pop, rng, settings.sampleSize, PayoffMatrix(settings))
+    CullAndBreed(pop, rng, settings)
+
+# Number of members of each group holding each strategy towards each group it meets, as a
+# (topology pairs, 16) table built with a single bincount
+def StrategyHistogram(pop):
+    numPairs = len(pop.topology.indices)
+    return np.bincount(pop.contactPairs * 16 + pop.contactStrategies(), minlength=numPairs * 16).reshape(numPairs, 16)
+
+# Percentage of the maximum chromosome value that each group holds towards each group it meets,
+# the same numbers MainSim writes out. Returns one value per topology pair
+def PopulationStats(pop):
+    histogram = StrategyHistogram(pop)
+    return histogram @ np.arange(16) * 100 / (maxStrategy * histogram.sum(axis=1))
+
+# Array version of RunReplicate
+def ArrayRunReplicate(rng, settings=defaultSettings, generations=1000, recorder=None, checkpointFile=None, checkpointEvery=1000, timer=None):
+    if recorder is None:
+        recorder = DefaultRecorder(settings=settings)
+    if checkpointFile is not None and os.path.exists(checkpointFile):
+        start, settings, pop = LoadCheckpoint(checkpointFile, recorder, rng)
+    else:
+        start = 0
+        pop = SetupPopulation(rng, settings)
+    for i in range(start, generations):
+        PopulationStep(pop, rng, settings, timer)
+        if recorder.due(i + 1):
+            recorder.record(i + 1, pop)
+            if timer is not None:
+                timer.lap("metrics")
+        if checkpointFile is not None and (i + 1) % checkpointEvery == 0:
+            SaveCheckpoint(checkpointFile, i + 1, settings, pop, recorder, rng)
+            if timer is not None:
+                timer.lap("checkpoint")
+        if timer is not None:
+            timer.endGeneration(i + 1)
+    return recorder.result()
+
+# Array version of MainSim
+def ArrayMainSim(settings=defaultSettings, generations=1000, seed=None, outFile="array_run.csv", timingFile=None):
+    timer = None if timingFile is None else phaseTimer(timingFile)
+    outputDF = ArrayRunReplicate(np.random.default_rng(seed), settings, generations, timer=timer)
+    outputDF.to_csv(outFile)
+    if timer is not None:
+        timer.result()
+    print("done!")
+    return outputDF
+
+
+################################## METRICS RECORDING ##################################
+
+# A metricsRecorder collects one row of statistics per recorded generation into a preallocated
+# NumPy buffer. When the buffer is full it is flushed, either to the end of a CSV or Parquet file
+# or, without a file, to a list of finished chunks kept in memory. Statistics are functions that
+# take a population and return one value per registered column name, e.g.
+#   recorder.register(PairingNames("coop_", settings), CooperationRateStat)
+# Setting every = k only records every k-th generation, which keeps long runs small.
+# Parquet output is a directory holding one part file per flushed chunk.
+
+# Names used for the groups in the output columns of the two-group model; with more groups
+# they are called group0, group1, ...
+groupNames = ["yellow", "green"]
+
+def GroupName(group, numGroups):
+    return groupNames[group] if numGroups == 2 else "group{0}".format(group)
+
+# Column names for a statistic with one value per group, e.g. score_yellows, score_greens
+def GroupNames(prefix="", settings=defaultSettings):
+    return [prefix + GroupName(group, settings.numGroups) + "s" for group in range(settings.numGroups)]
+
+# Column names for a statistic with one value per pair of groups that meet, e.g. yellows_green
+def PairingNames(prefix="", settings=defaultSettings):
+    topology = settings.topology
+    return [prefix + GroupName(group, topology.numGroups) + "s_" + GroupName(opponentGroup, topology.numGroups)
+            for group, opponentGroup in zip(topology.sources(), topology.indices)]
+
+# Strategy percentages of each group towards each group it meets, the original model output
+def StrategyStat(pop):
+    return PopulationStats(pop)
+
+# Mean score of each group in the last generation
+def MeanScoreStat(pop):
+    return np.add.reduceat(pop.scores, pop.groupStarts[:-1]) / pop.groupSizes()
+
+# Fraction of games in which members of each group cooperated with each group they meet in the last generation.
+# Before any games have been played (generation 0) the rates are NaN
+def CooperationRateStat(pop):
+    totals = np.bincount(pop.contactPairs, weights=pop.cooperations, minlength=len(pop.topology.indices))
+    if pop.sampleSize == 0:
+        return np.full(len(totals), np.nan)
+    return totals / (pop.groupSizes()[pop.topology.sources()] * pop.sampleSize)
+
+# Shannon entropy (in bits) of the chromosomes each group holds towards each group it meets.
+# 0 means every member carries the same chromosome, 4 means all 16 chromosomes are equally common
+def DiversityStat(pop):
+    counts = StrategyHistogram(pop)
+    p = counts / counts.sum(axis=1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return -np.where(counts > 0, p * np.log2(p), 0.0).sum(axis=1)
+
+# Recorder that keeps the original model output: strategy percentages of every group
+def DefaultRecorder(outFile=None, every=1, settings=defaultSettings):
+    recorder = metricsRecorder(outFile, every)
+    recorder.register(PairingNames(settings=settings), StrategyStat)
+    return recorder
+
+class metricsRecorder():
+
+    def __init__(self, outFile=None, every=1, chunkSize=10000):
+        self.outFile = outFile
+        self.every = every
+        self.chunkSize = chunkSize
+        self.columns = ['generation']
+        self.stats = []
+        self.buffer = None
+        self.rows = 0
+        self.chunks = []
+        self.started = False
+        self.parts = 0
+        if outFile is not None and outFile.endswith(".parquet") and pq is None:
+            raise ImportError("pyarrow is required to write Parquet files")
+
+    # Add a statistic: function(pop) returns one value for each of the given column names
+    def register(self, names, function):
+        if self.buffer is not None:
+            raise RuntimeError("statistics must be registered before the first record")
+        self.columns.extend(names)
+        self.stats.append((len(names), function))
+
+    # True if this generation should be recorded
+    def due(self, generation):
+        return generation % self.every == 0
+
+    def record(self, generation, pop):
+        if self.buffer is None:
+            self.buffer = np.empty((self.chunkSize, len(self.columns)))
+        row = self.buffer[self.rows]
+        row[0] = generation
+        column = 1
+        for width, function in self.stats:
+            row[column:column + width] = function(pop)
+            column += width
+        self.rows += 1
+        if self.rows == self.chunkSize:
+            self.flush()
+
+    # Move the filled part of the buffer to the output file, or to memory if there is no file
+    def flush(self):
+        if self.rows == 0:
+            return
+        chunk = pd.DataFrame(self.buffer[:self.rows].copy(), columns=self.columns)
+        chunk['generation'] = chunk['generation'].astype(np.int64)
+        self.rows = 0
+        if self.outFile is None:
+            self.chunks.append(chunk)
+        elif self.outFile.endswith(".parquet"):
+            if not self.started:
+                # the first chunk replaces any old output
+                os.makedirs(self.outFile, exist_ok=True)
+                for part in self.PartFiles():
+                    os.remove(part)
+            pq.write_table(pa.Table.from_pandas(chunk, preserve_index=False), self.PartFile(self.parts))
+            self.parts += 1
+        else:
+            # the first chunk replaces any old file, later chunks are appended to it
+            chunk.to_csv(self.outFile, mode='a' if self.started else 'w', header=not self.started, index=False)
+        self.started = True
+
+    def PartFile(self, index):
+        return os.path.join(self.outFile, "part-{0:05d}.parquet".format(index))
+
+    def PartFiles(self):
+        return sorted(os.path.join(self.outFile, name) for name in os.listdir(self.outFile) if name.startswith("part-"))
+
+    # Flush what is left
+    def close(self):
+        self.flush()
+
+    # Everything recorded so far as one DataFrame
+    def result(self):
+        self.close()
+        if self.outFile is None:
+            return pd.concat(self.chunks, ignore_index=True) if self.chunks else pd.DataFrame(columns=self.columns)
+        if self.outFile.endswith(".parquet"):
+            parts = [pd.read_parquet(part) for part in self.PartFiles()]
+            return pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=self.columns)
+        return pd.read_csv(self.outFile, float_precision="round_trip")
+
+    # Everything needed to carry on recording after a restart, as arrays for a checkpoint.
+    # Rows held in memory are saved; rows already written out are remembered by the size of the
+    # output, so anything written after the checkpoint can be dropped again on restore
+    def state(self):
+        self.flush()
+        if self.outFile is None:
+            rows = pd.concat(self.chunks, ignore_index=True).to_numpy(dtype=float) if self.chunks else np.empty((0, len(self.columns)))
+            written = 0
+        elif self.outFile.endswith(".parquet"):
+            rows = np.empty((0, len(self.columns)))
+            written = self.parts
+        else:
+            rows = np.empty((0, len(self.columns)))
+            written = os.path.getsize(self.outFile) if self.started else 0
+        return {"columns": np.array(self.columns), "rows": rows, "written": written}
+
+    # Return the recorder to a saved state. The same statistics must have been registered
+    def restore(self, state):
+        if list(state["columns"]) != self.columns:
+            raise ValueError("recorder columns do not match the checkpoint")
+        written = int(state["written"])
+        self.buffer = np.empty((self.chunkSize, len(self.columns)))
+        self.rows = 0
+        self.chunks = []
+        self.started = written > 0
+        if self.outFile is None:
+            if len(state["rows"]) > 0:
+                chunk = pd.DataFrame(state["rows"], columns=self.columns)
+                chunk['generation'] = chunk['generation'].astype(np.int64)
+                self.chunks.append(chunk)
+                self.started = True
+        elif self.outFile.endswith(".parquet"):
+            self.parts = written
+            if os.path.isdir(self.outFile):
+                for part in self.PartFiles()[written:]:
+                    os.remove(part)
+        elif self.started:
+            with open(self.outFile, "r+b") as outputStream:
+                outputStream.truncate(written)
+
+
+##################################### CHECKPOINTS #####################################
+
+# A checkpoint is a single .npz file holding everything a run needs to carry on exactly where it
+# stopped: the generation, the settings (including the ID counter and the group topology),
+# every agent in list order,
+# the states of random, np.random and the array engine's Generator, and the recorder's rows.
+# It is written to a temporary file first and then renamed, so a crash while saving leaves the
+# previous checkpoint in place. A run restarted from a checkpoint gives bit-identical results.
+
+def SaveCheckpoint(checkpointFile, generation, settings, state, recorder=None, rng=None):
+    randomVersion, randomInternal, gaussNext = random.getstate()
+    npName, npKeys, npPos, npHasGauss, npGauss = np.random.get_state()
+    arrays = {"generation": generation,
+              "settings": json.dumps({name: value for name, value in vars(settings).items() if name != "topology"}),
+              "topologyIndptr": settings.topology.indptr,
+              "topologyIndices": settings.topology.indices,
+              "topologyName": settings.topology.name,
+              "randomVersion": randomVersion,
+              "randomInternal": np.array(randomInternal, dtype=np.int64),
+              "randomGauss": np.nan if gaussNext is None else gaussNext,
+              "npKeys": npKeys,
+              "npPos": npPos,
+              "npHasGauss": npHasGauss,
+              "npGauss": npGauss}
+    if rng is not None:
+        arrays["rngState"] = json.dumps(rng.bit_generator.state)
+    if isinstance(state, population):
+        arrays["engine"] = "array"
+        for name in ["chromosomes", "scores", "groups", "agentIDs", "cooperations", "IDSequence", "sampleSize"]:
+            arrays["pop_" + name] = getattr(state, name)
+    else:
+        # the agent model is saved as one flat list of agents, group after group
+        agents = [x for group in state for x in group]
+        arrays["engine"] = "agent"
+        arrays["agent_groupLengths"] = np.array([len(group) for group in state], dtype=np.int64)
+        arrays["agent_IDs"] = np.array([x.agentID for x in agents], dtype=np.int64)
+        arrays["agent_chromosomes"] = np.stack([x.chromosome for x in agents])
+        arrays["agent_scores"] = np.array([x.score for x in agents], dtype=float)
+        arrays["agent_choices"] = np.array([x.choice for x in agents], dtype=np.int8)
+        arrays["agent_cooperationLengths"] = np.array([len(x.cooperations) for x in agents], dtype=np.int64)
+        arrays["agent_cooperations"] = np.fromiter(itertools.chain.from_iterable(x.cooperations for x in agents), dtype=np.int64)
+    if recorder is not None:
+        for name, value in recorder.state().items():
+            arrays["metrics_" + name] = value
+    with open(checkpointFile + ".tmp", "wb") as outputStream:
+        np.savez(outputStream, **arrays)
+    os.replace(checkpointFile + ".tmp", checkpointFile)
+
+# Load a checkpoint and restore the random states, the recorder and (for the array engine) the
+# given Generator. Returns the generation, the settings and either the list of groups
+# or the population
+def LoadCheckpoint(checkpointFile, recorder=None, rng=None):
+    with np.load(checkpointFile) as data:
+        topology = groupTopology(data["topologyIndptr"], data["topologyIndices"], str(data["topologyName"]))
+        settings = modelSettings(topology=topology)
+        settings.__dict__.update(json.loads(str(data["settings"])))
+        gaussNext = float(data["randomGauss"])
+        random.setstate((int(data["randomVersion"]), tuple(data["randomInternal"].tolist()),
+                         None if np.isnan(gaussNext) else gaussNext))
+        np.random.set_state(("MT19937", data["npKeys"], int(data["npPos"]),
+                             int(data["npHasGauss"]), float(data["npGauss"])))
+        if rng is not None:
+            rng.bit_generator.state = json.loads(str(data["rngState"]))
+        if str(data["engine"]) == "array":
+            state = population(data["pop_chromosomes"], data["pop_scores"], data["pop_groups"],
+                               data["pop_agentIDs"], int(data["pop_IDSequence"]), topology)
+            state.cooperations = data["pop_cooperations"]
+            state.sampleSize = int(data["pop_sampleSize"])
+        else:
+            cooperations = data["agent_cooperations"].tolist()
+            cooperationStarts = np.concatenate([[0], np.cumsum(data["agent_cooperationLengths"])]).tolist()
+            groupIDs = np.repeat(np.arange(len(data["agent_groupLengths"])), data["agent_groupLengths"]).tolist()
+            state = [[] for length in data["agent_groupLengths"]]
+            for index, (agentID, chromosome, score, choice, group) in enumerate(zip(
+                    data["agent_IDs"].tolist(), data["agent_chromosomes"], data["agent_scores"].tolist(),
+                    data["agent_choices"].tolist(), groupIDs)):
+                tempAgent = agent(agentID, chromosome.copy(), score, group, choice)
+                tempAgent.cooperations = cooperations[cooperationStarts[index]:cooperationStarts[index + 1]]
+                state[group].append(tempAgent)
+        if recorder is not None:
+            recorder.restore({name: data["metrics_" + name] for name in ["columns", "rows", "written"]})
+        return int(data["generation"]), settings, state
+
+
+################################### PARAMETER SWEEPS ###################################
+
+# A sweep runs every combination of the values in a grid, e.g.
+#   {"payoffs": [(5, 0, -5, 0), (3, 5, 0, 1)], "cullSize": [10, 20], "topology": [RingTopology(10)]}
+# "payoffs" entries are (reward, temptation, sucker, punishment) tuples; every other key is a
+# modelSettings field. Each (grid point, replicate) pair is an independent job run in a process pool.
+
+# Column names of the parameters in the sweep output
+sweepColumns = ['rewardPayoff', 'temptationPayoff', 'suckerPayoff', 'punishmentPayoff',
+                'groupSize', 'sampleSize', 'cullSize', 'mutationRate', 'selection', 'selectionParameter',
+                'numGroups', 'topology']
+
+# Build a fresh settings object (with its own ID counter) for one grid point
+def SweepSettings(point):
+    point = dict(point)
+    if "payoffs" in point:
+        (point["rewardPayoff"], point["temptationPayoff"],
+         point["suckerPayoff"], point["punishmentPayoff"]) = point.pop("payoffs")
+    return modelSettings(**point)
+
+# Value of a sweep column for the given settings; the topology is given by its key
+def SweepColumnValue(settings, column):
+    return settings.topology.key() if column == 'topology' else getattr(settings, column)
+
+# Name of the parameter set, used in the job file names and to derive the job seeds
+def SweepPointName(settings):
+    return "R{0}_T{1}_S{2}_P{3}_n{4}_s{5}_c{6}_m{7}_{8}-{9}_g{10}-{11}".format(*[SweepColumnValue(settings, column) for column in sweepColumns])
+
+# Run one sweep job and write its output next to the others. Every job seeds its own random
+# streams from its name and replicate number, so a job gives the same result whichever worker
+# runs it and whether or not the sweep was resumed. The output is written under a temporary
+# name first, so a crash never leaves a partial file behind that would be mistaken for a finished job
+def RunSweepJob(job):
+    settings, replicate, seedSequence, generations, engine, outFile = job
+    try:
+        if engine == "array":
+            outputDF = ArrayRunReplicate(np.random.default_rng(seedSequence), settings, generations)
+        else:
+            seedState = seedSequence.generate_state(4)
+            random.seed(int.from_bytes(seedState.tobytes(), "little"))
+            np.random.seed(seedState)
+            outputDF = RunReplicate(settings, generations)
+    except ValueError as error:
+        return outFile, str(error)
+    outputDF.insert(0, 'replicate', replicate)
+    for column in reversed(sweepColumns):
+        outputDF.insert(0, column, SweepColumnValue(settings, column))
+    outputDF.to_csv(outFile + ".tmp", index=False)
+    os.replace(outFile + ".tmp", outFile)
+    return outFile, None
+
+# Run every (grid point, replicate) job of a sweep across a pool of worker processes, one per core
+# unless told otherwise, and collect all results into one tidy table with a row per generation.
+# Finished jobs are kept in outDir/jobs, so calling this again after a crash only runs the jobs
+# that are missing. Jobs that fail are reported and left out. Grid points with the same parameters
+# would write the same job files, so they are rejected before anything runs
+def RunSweep(grid, replicates=100, generations=1000, outDir="sweep", engine="agent", processes=None, baseSeed=0):
+    jobDir = os.path.join(outDir, "jobs")
+    os.makedirs(jobDir, exist_ok=True)
+    jobs = []
+    jobFiles = []
+    pointNames = set()
+    for values in itertools.product(*grid.values()):
+        settings = SweepSettings(zip(grid.keys(), values))
+        pointName = SweepPointName(settings)
+        if pointName in pointNames:
+            raise ValueError("the grid holds the parameter set %s more than once" % (pointName))
+        pointNames.add(pointName)
+        for replicate in range(replicates):
+            outFile = os.path.join(jobDir, "{0}_{1}_rep{2}.csv".format(engine, pointName, replicate))
+            jobFiles.append(outFile)
+            if not os.path.exists(outFile):
+                seedSequence = np.random.SeedSequence(baseSeed, spawn_key=(zlib.crc32(pointName.encode()), replicate))
+                jobs.append((settings, replicate, seedSequence, generations, engine, outFile))
+    print("%d jobs, %d already finished" % (len(jobFiles), len(jobFiles) - len(jobs)))
+
+    failed = []
+    with multiprocessing.Pool(processes) as pool:
+        for done, (outFile, error) in enumerate(pool.imap_unordered(RunSweepJob, jobs), 1):
+            if error is not None:
+                failed.append(outFile)
+                print("failed: %s (%s)" % (os.path.basename(outFile), error))
+            print("%d / %d" % (done, len(jobs)))
+    if failed:
+        print("%d jobs failed and are left out of the results" % (len(failed)))
+
+    finished = [pd.read_csv(outFile) for outFile in jobFiles if os.path.exists(outFile)]
+    outputDF = pd.concat(finished, ignore_index=True) if finished else pd.DataFrame()
+    outputDF.to_csv(os.path.join(outDir, "sweep_results.csv"), index=False)
+    print("done!")
+    return outputDF
+
+
+##################################### PHASE TIMING #####################################
+
+# A phaseTimer logs where the time of every generation goes: the wall time and number of calls of
+# each phase, and counters such as interactions and births with their rates per second of the
+# whole generation. Phases are timed from one mark to the next: begin() sets the mark at the start
+# of a generation, and lap(phase) adds the time since the last mark to the phase and moves the mark.
+# Runs without a timer never reach any of this, so they pay one "is None" check per generation.
+# One row is kept per generation, and result() writes them to outFile (CSV) if there is one
+
+class phaseTimer():
+
+    def __init__(self, outFile=None):
+        self.outFile = outFile
+        self.rows = []
+        self.phases = {}
+        self.counters = {}
+        self.started = None
+        self.mark = None
+
+    def begin(self):
+        self.mark = time.perf_counter()
+        if self.started is None:
+            self.started = self.mark
+
+    def lap(self, phase, calls=1):
+        now = time.perf_counter()
+        seconds, count = self.phases.get(phase, (0.0, 0))
+        self.phases[phase] = (seconds + now - self.mark, count + calls)
+        self.mark = now
+
+    def count(self, name, amount):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    # Close the row of this generation and start the next one
+    def endGeneration(self, generation):
+        total = self.mark - self.started
+        row = {'generation': generation, 'seconds': total}
+        for phase, (seconds, calls) in self.phases.items():
+            row[phase + '_seconds'] = seconds
+            row[phase + '_calls'] = calls
+        for name, amount in self.counters.items():
+            row[name] = amount
+            row[name + '_per_second'] = amount / total if total > 0 else np.nan
+        self.rows.append(row)
+        self.phases = {}
+        self.counters = {}
+        self.started = None
+
+    # All generations as one DataFrame, with any extra columns (e.g. replicate=j) in front.
+    # Phases that did not run in a generation (metrics that are not due) show 0
+    def result(self, **columns):
+        outputDF = pd.DataFrame(self.rows)
+        phaseColumns = [column for column in outputDF.columns if column.endswith(('_seconds', '_calls'))]
+        outputDF[phaseColumns] = outputDF[phaseColumns].fillna(0)
+        for name, value in reversed(list(columns.items())):
+            outputDF.insert(0, name, value)
+        if self.outFile is not None:
+            outputDF.to_csv(self.outFile, index=False)
+        return outputDF
+
+# ModelStep with every phase timed. AgentStep is timed together with the Interact and SelectChoice
+# calls it makes: those run millions of times per generation, so they are counted instead of timed,
+# as timing each call would cost more than the call itself. Breeding and mutation are timed group
+# by group, so the random draws happen in the same order as in ModelStep and the results are the same
+def TimedModelStep(groups, settings, timer):
+    timer.begin()
+    for group in groups:
+        np.random.shuffle(group)
+    timer.lap("shuffle", len(groups))
+    interactions = 0
+    for groupID, group in enumerate(groups):
+        for index, agent in enumerate(group):
+            AgentStep(agent, index, groups, settings)
+        timer.lap("agentStep", len(group))
+        interactions += len(group) * len(settings.topology.neighborLists[groupID]) * settings.sampleSize
+    timer.count("interactions", interactions)
+    for group in groups:
+        CullAgents(group, settings)
+    timer.lap("cullAgents", len(groups))
+    births = 0
+    mutations = 0
+    for group in groups:
+        children = BreedChildren(group, settings)
+        timer.lap("breedAgents")
+        mutations += MutateChildren(children, settings)
+        group.extend(children)
+        timer.lap("mutate")
+        births += len(children)
+    timer.count("births", births)
+    timer.count("mutations", mutations)
+
+# PopulationStep with its two phases timed
+def TimedPopulationStep(pop, rng, settings, timer):
+    timer.begin()
+    PlayGeneration(pop, rng, settings.sampleSize, PayoffMatrix(settings))
+    timer.lap("playGeneration")
+    timer.count("interactions", int((pop.groupSizes() * pop.topology.degrees()).sum()) * settings.sampleSize)
+    CullAndBreed(pop, rng, settings)
+    timer.lap("cullAndBreed")
+    timer.count("births", settings.cullSize * pop.topology.numGroups)
+
+
+###################################### BENCHMARKS ######################################
+
+# AgentStep and BreedAgents as they were before opponents were sampled by position and children
+# cloned only their chromosomes: every agent rebuilds both opponent lists, and every child is a
+# deep copy. They are only kept so BenchmarkGenerationTime can compare against them
+def LegacyAgentStep(agent, agentIndex, groups, settings=defaultSettings):
+    agent.score = 0
+    neighbors = settings.topology.neighborLists[agent.group]
+    agent.cooperations = [0] * len(neighbors)
+    for position, opponentGroup in enumerate(neighbors):
+        tempGroup = []
+        for tempAgent in groups[opponentGroup]:
+            if tempAgent.agentID != agent.agentID:
+                tempGroup.append(tempAgent)
+        for opponent in random.sample(tempGroup, settings.sampleSize):
+            Interact(agent, opponent, settings)
+            agent.cooperations[position] += agent.choice
+
+def LegacyBreedAgents(group, settings=defaultSettings):
+    tempWeights = []
+    for agent in group:
+        tempWeights.append(agent.score)
+    tempGroup = []
+    for i in range(settings.cullSize):
+        tempAgentList = copy.deepcopy(random.choices(group, weights = tempWeights, k=1))
+        tempAgentList[0].agentID = settings.nextID()
+        Mutate(tempAgentList[0], settings)
+        tempGroup.extend(tempAgentList)
+    group.extend(tempGroup)
+
+# Time the average generation of ModelStep, using the given agent step and breeding functions
+def TimeGenerations(settings, generations, agentStep, breedAgents, seed=0):
+    random.seed(seed)
+    np.random.seed(seed)
+    groups = []
+    SetupAgents(groups, settings)
+    start = time.perf_counter()
+    for i in range(generations):
+        for group in groups:
+            np.random.shuffle(group)
+        for group in groups:
+            for index, agent in enumerate(group):
+                agentStep(agent, index, groups, settings)
+        for group in groups:
+            CullAgents(group, settings)
+        for group in groups:
+            breedAgents(group, settings)
+    return (time.perf_counter() - start) / generations
+
+# Compare the generation time of the agent model before and after the change, for populations of
+# 100 up to 100k agents. The old version rebuilds its lists in O(N^2) per generation, so it is
+# skipped above legacyLimit agents. Scores are kept non-negative so breeding never runs out of weight
+def BenchmarkGenerationTime(sizes=(100, 1000, 10000, 100000), generations=3, legacyLimit=10000, seed=0):
+    rows = []
+    for size in sizes:
+        settings = modelSettings(suckerPayoff=0, groupSize=size // 2)
+        legacyTime = np.nan
+        if size <= legacyLimit:
+            legacyTime = TimeGenerations(settings, generations, LegacyAgentStep, LegacyBreedAgents, seed)
+        newTime = TimeGenerations(settings, generations, AgentStep, BreedAgents, seed)
+        rows.append([size, legacyTime, newTime, legacyTime / newTime])
+        print("%7d agents: before %9.4f s, after %9.4f s per generation" % (size, legacyTime, newTime))
+    return pd.DataFrame(rows, columns=['agents', 'before_seconds', 'after_seconds', 'speedup'])
+
+# Run either engine with a phaseTimer for every population size and fixed seed, and average the
+# phase times and rates over the generations. The rows are labelled with version and added to
+# outFile, so the figures of different versions of the model can be compared to spot regressions
+def BenchmarkPhases(sizes=(1000, 10000), seeds=(0, 1, 2), generations=5, engine="agent", version="current", outFile="phase_benchmark.csv"):
+    rows = []
+    for size in sizes:
+        for seed in seeds:
+            settings = modelSettings(groupSize=size // 2)
+            timer = phaseTimer()
+            if engine == "array":
+                ArrayRunReplicate(np.random.default_rng(seed), settings, generations, timer=timer)
+            else:
+                random.seed(seed)
+                np.random.seed(seed)
+                RunReplicate(settings, generations, timer=timer)
+            means = timer.result().drop(columns='generation').mean()
+            rows.append(pd.concat([pd.Series({'version': version, 'engine': engine, 'agents': size,
+                                              'seed': seed, 'generations': generations}, dtype=object), means]))
+            print("%7d agents, seed %d: %9.4f s per generation" % (size, seed, means['seconds']))
+    outputDF = pd.DataFrame(rows)
+    if outFile is not None:
+        previous = [pd.read_csv(outFile)] if os.path.exists(outFile) else []
+        pd.concat(previous + [outputDF], ignore_index=True).to_csv(outFile, index=False)
+    return outputDF
+
+
+if __name__ == "__main__":
+    MainSim()
+    # RunSweep({"payoffs": [(5, 0, -5, 0)], "cullSize": [10, 20], "sampleSize": [10, 20],
+    #           "mutationRate": [0.001, 0.01]}, replicates=100)
+    # BenchmarkGenerationTime()
+    # BenchmarkPhases(version="v1")
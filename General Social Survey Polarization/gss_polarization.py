@@ -16,59 +16,605 @@ from networkx.algorithms import community # to support community detection
 import matplotlib.pyplot as plt # Import plotting library
 import random # Import random number generator library
 import numpy as np # for processing data
+import pandas as pd # for writing the report table
 import math # For combination calculation
-import copy # for deep copy
+import time # for timing the network builders
+import os # for checking edge files and the graph cache
+import hashlib # for naming cached graphs after their input
+import json # for describing answer stores
+import multiprocessing # for computing edges in parallel
+try:
+    import scipy.sparse as sparse # for counting triangles with sparse matrix products
+    import scipy.sparse.csgraph # for finding connected components
+except ImportError:
+    sparse = None
 from matplotlib.axes._axes import _log as matplotlib_axes_logger # to suppress warnings
 
 ## IMPORT DATA ----------------------------------------------------------------
 
-# This function loads a network file and creates a NetworkX object based on it
-def createNetworkFromFile(inFile):
+# This function loads a GSS data file into a matrix of answer codes, one row per respondent
+# and one column per question. Answers are compared as text, the same way the original builder did,
+# so each column is recoded to the integers 0 .. (number of distinct answers - 1)
+def loadAnswerMatrix(inFile):
+    
+    # read every answer as text, skipping the header line with the question names
+    rawAnswers = np.loadtxt(inFile, dtype=str, delimiter=",", skiprows=1, ndmin=2)
+    # recode each question separately, so that equal answers get equal codes
+    answers = np.empty(rawAnswers.shape, dtype=np.int32)
+    for question in range(rawAnswers.shape[1]):
+        answers[:, question] = np.unique(rawAnswers[:, question], return_inverse=True)[1].ravel()
+        
+    return answers
 
-     # Read in the file specified in the input
-     inputStream = open(inFile, 'r')
-     # Create placeholders for our data
-     lines = []
-     dataset = []
-     outGraph = nx.Graph()
-     
+# This function turns the answer matrix into a one-hot matrix with a column for every
+# (question, answer) combination. The dot product of two rows is then the number of
+# questions on which the two respondents gave the same answer.
+# missing can pass in a mask of non-responses (see answerStore); those answers get no 1, so two
+# respondents who both did not answer a question are not counted as agreeing on it
+def oneHotAnswers(answers, missing=None):
+    
+    # give every question its own range of columns
+    offsets = np.concatenate([[0], np.cumsum(answers.max(axis=0).astype(np.int64) + 1)[:-1]])
+    numColumns = int(offsets[-1] + answers[:, -1].max() + 1)
+    oneHot = np.zeros((answers.shape[0], numColumns), dtype=np.float32)
+    # set a single 1 per question in every row
+    oneHot[np.arange(answers.shape[0])[:, None], answers + offsets] = 1 if missing is None else ~np.asarray(missing)
+    
+    return oneHot
 
-     # create a list containing every line in the file
-     for line in inputStream:
-         lines.append(line.strip())
-          
-     # Stop reading the file
-     inputStream.close()
-     
-     for singleLine in lines[1:]:
-         dataset.append(singleLine.split(","))
-     
-     # process the list of values into a network
-     for lineIterator1 in range(len(dataset)):
-         # we need to add every node, even if it will not be connected
-         outGraph.add_node(lineIterator1)
-         for lineIterator2 in range(lineIterator1+1,len(dataset)):
-             # reset the count of matching answers
-             matches = 0
-             # loop through the answers to find matches
-             for answersIterator in range(len(dataset[lineIterator1])):
-                 if (dataset[lineIterator1][answersIterator] == dataset[lineIterator2][answersIterator]):
-                     # increment match counter
-                     matches = matches + 1
-             # if the number of matches is greather than threshold, create an edge
-             # The threshold is calculated based on a normal distribution approximation,
-             # where the mean is calculated as n*p,
-             # and the standard deviation is calculated as sqrt(n*p*(1-p)), where
-             # n = the number of answers and p = average probability of an answer in a question.
-             # For 1978, 1988, 1998 and 2018, change the number below to 11
-             # For 2008, change the number to 10
-             if matches > 11:
-                 outGraph.add_edge(lineIterator1, lineIterator2)
-         
-     # return the final completed network
-     return outGraph
+## ANSWER STORE ---------------------------------------------------------------------------------
+
+# The full cumulative GSS file has tens of thousands of respondents and thousands of questions,
+# too many to parse as text for every network. An answer store parses the CSV once into a
+# directory holding:
+#   answers.npy - the answer codes as int8, stored column by column, so reading a few questions
+#                 only touches those columns
+#   missing.npy - a mask of the non-responses (see missingCodes), in the same layout
+#   years.npy   - the survey year of every respondent, if the file has a year column
+#   store.json  - the question names, the answer text of every code and the missing codes of every question
+# The arrays are opened as read-only memory maps, so every network built from the store reads
+# from the same buffer instead of a copy. Answers are coded per question like loadAnswerMatrix does.
+
+# GSS codes for non-responses: inapplicable (-100), no answer (-99), don't know (-98), skipped (-97)
+# and empty fields. Recent releases use these negative codes for every question, and they are
+# never real answers, so they are used for every question without codes in columnMissingCodes
+missingCodes = ("", "-97", "-98", "-99", "-100")
+
+# The one-digit codes of the reduced files: inapplicable (0), don't know (8) and no answer (9),
+# along with the codes above. In other files 0, 8 and 9 are often real answers, so these are
+# only used when passed to buildAnswerStore as missingCodes
+reducedMissingCodes = missingCodes + ("0", "8", "9")
+
+# Non-response codes of questions that use two-digit codes, or where 0 or 8 are real answers
+# even in the reduced files. Question names match in any case; more questions can be passed to buildAnswerStore
+columnMissingCodes = {
+    # number of children: 0 is none and 8 is eight or more, 9 is no answer
+    "CHILDS": ("", "9", "-97", "-98", "-99", "-100"),
+    # years of school: 0 is no formal schooling, 97 inapplicable, 98 don't know, 99 no answer
+    "EDUC": ("", "97", "98", "99", "-97", "-98", "-99", "-100"),
+    # age: 89 is 89 or older, 98 don't know, 99 no answer
+    "AGE": ("", "98", "99", "-97", "-98", "-99", "-100"),
+}
+
+# version of the store layout, written to store.json
+answerStoreVersion = 2
+
+class answerStore():
+    
+    def __init__(self, storeDir):
+        with open(os.path.join(storeDir, "store.json")) as inputStream:
+            description = json.load(inputStream)
+        if description["version"] != answerStoreVersion:
+            raise ValueError("%s was written by another version of the answer store, build it again" % (storeDir))
+        self.storeDir = storeDir
+        self.columns = description["columns"]
+        self.labels = description["labels"]
+        # the non-response codes of every question
+        self.missingCodes = description["missingCodes"]
+        rows = description["rows"]
+        # the arrays may be allocated for a few more rows than the file had, see buildAnswerStore
+        self.answers = np.load(os.path.join(storeDir, "answers.npy"), mmap_mode="r")[:rows]
+        self.missing = np.load(os.path.join(storeDir, "missing.npy"), mmap_mode="r")[:rows]
+        yearFile = os.path.join(storeDir, "years.npy")
+        self.years = np.load(yearFile, mmap_mode="r")[:rows] if os.path.exists(yearFile) else None
+    
+    def __len__(self):
+        return self.answers.shape[0]
+    
+    # This function returns the answer codes and the missing mask of the respondents of the given
+    # years and the given questions (by name), in store order. Without years and columns these
+    # are the memory maps themselves; otherwise only the selected parts are read
+    def select(self, years=None, columns=None):
+        answers = self.answers
+        missing = self.missing
+        if columns is not None:
+            positions = [self.columns.index(column) for column in columns]
+            answers = answers[:, positions]
+            missing = missing[:, positions]
+        if years is not None:
+            if self.years is None:
+                raise ValueError("%s has no year column" % (self.storeDir))
+            rows = np.flatnonzero(np.isin(self.years, years))
+            answers = answers[rows]
+            missing = missing[rows]
+        
+        return answers, missing
+
+# This function counts the lines of a file without parsing them, to size the store before reading
+def countLines(inFile):
+    
+    lines = 0
+    with open(inFile, "rb") as inputStream:
+        for block in iter(lambda: inputStream.read(1 << 24), b""):
+            lines += block.count(b"\n")
+            last = block
+    # the last line may not end with a line break
+    return lines + (lines > 0 and not last.endswith(b"\n"))
+
+# This function parses a GSS CSV file once into an answer store in storeDir and returns it.
+# The file is read chunkSize rows at a time and every question column is coded as it is read;
+# codes are numbered in order of appearance and renumbered in answer text order at the end.
+# Questions with more than 128 different answers (respondent ids, ages in years) do not fit in
+# int8 and are left out, as are columns listed in skipColumns. The year column (yearColumn, any
+# case) is kept separately. Answers are marked as missing by the codes of their question in
+# columnMissingCodes ({question: codes}, any case), or by missingCodes for all other questions;
+# pass reducedMissingCodes as missingCodes for files that use the one-digit codes of the reduced files
+def buildAnswerStore(inFile, storeDir, missingCodes=missingCodes, columnMissingCodes=columnMissingCodes, yearColumn="YEAR",
+                     skipColumns=(), chunkSize=100000):
+    
+    header = pd.read_csv(inFile, nrows=0).columns.tolist()
+    yearName = next((name for name in header if name.upper() == yearColumn.upper()), None)
+    columns = [name for name in header if name != yearName and name not in skipColumns]
+    questionCodes = {name.upper(): list(codes) for name, codes in columnMissingCodes.items()}
+    missingByColumn = [questionCodes.get(column.upper(), list(missingCodes)) for column in columns]
+    # the data lines, at most; a quoted field with a line break would make it too many
+    numberOfRows = max(countLines(inFile) - 1, 0)
+    
+    # write to a temporary directory first, so that an interrupted build never leaves a broken store
+    buildDir = storeDir + ".tmp"
+    os.makedirs(buildDir, exist_ok=True)
+    answers = np.lib.format.open_memmap(os.path.join(buildDir, "answers.npy"), mode="w+", dtype=np.int8,
+                                        shape=(numberOfRows, len(columns)), fortran_order=True)
+    missing = np.lib.format.open_memmap(os.path.join(buildDir, "missing.npy"), mode="w+", dtype=np.bool_,
+                                        shape=(numberOfRows, len(columns)), fortran_order=True)
+    years = None
+    if yearName is not None:
+        years = np.lib.format.open_memmap(os.path.join(buildDir, "years.npy"), mode="w+", dtype=np.int16, shape=(numberOfRows,))
+    codes = [{} for column in columns]
+    tooMany = set()
+    rows = 0
+    for chunk in pd.read_csv(inFile, dtype=str, keep_default_na=False, chunksize=chunkSize):
+        chunkRows = slice(rows, rows + len(chunk))
+        if years is not None:
+            years[chunkRows] = pd.to_numeric(chunk[yearName]).to_numpy()
+        for position, column in enumerate(columns):
+            if position in tooMany:
+                continue
+            values = chunk[column].str.strip().to_numpy()
+            distinct, inverse = np.unique(values, return_inverse=True)
+            columnCodes = codes[position]
+            for answer in distinct:
+                columnCodes.setdefault(answer, len(columnCodes))
+            if len(columnCodes) > 128:
+                tooMany.add(position)
+                continue
+            answers[chunkRows, position] = np.array([columnCodes[answer] for answer in distinct], dtype=np.int8)[inverse.ravel()]
+            missing[chunkRows, position] = np.isin(distinct, missingByColumn[position])[inverse.ravel()]
+        rows += len(chunk)
+    
+    # renumber the codes of every question in answer text order, one column at a time
+    labels = {}
+    for position, column in enumerate(columns):
+        if position in tooMany:
+            print("left out %s: more than 128 different answers" % (column))
+            continue
+        text = sorted(codes[position])
+        renumber = np.empty(max(len(text), 1), dtype=np.int8)
+        renumber[[codes[position][answer] for answer in text]] = np.arange(len(text))
+        answers[:rows, position] = renumber[answers[:rows, position]]
+        labels[column] = text
+    kept = [position for position in range(len(columns)) if position not in tooMany]
+    if tooMany:
+        # copy the columns that fit into new arrays, which replace the old ones below
+        for name, array in (("answers.npy", answers), ("missing.npy", missing)):
+            keptArray = np.lib.format.open_memmap(os.path.join(buildDir, "kept_" + name), mode="w+", dtype=array.dtype,
+                                                  shape=(numberOfRows, len(kept)), fortran_order=True)
+            for newPosition, position in enumerate(kept):
+                keptArray[:, newPosition] = array[:, position]
+            keptArray.flush()
+            del keptArray
+    # close the memory maps before any of their files are replaced
+    for array in (answers, missing, years):
+        if array is not None:
+            array.flush()
+    del answers, missing, years, array
+    if tooMany:
+        for name in ("answers.npy", "missing.npy"):
+            os.replace(os.path.join(buildDir, "kept_" + name), os.path.join(buildDir, name))
+    
+    description = {"version": answerStoreVersion, "source": os.path.abspath(inFile), "rows": rows,
+                   "columns": [columns[position] for position in kept], "labels": labels,
+                   "missingCodes": {columns[position]: missingByColumn[position] for position in kept}}
+    with open(os.path.join(buildDir, "store.json"), "w") as outputStream:
+        json.dump(description, outputStream)
+    if os.path.exists(storeDir):
+        for name in os.listdir(storeDir):
+            os.remove(os.path.join(storeDir, name))
+        os.rmdir(storeDir)
+    os.replace(buildDir, storeDir)
+    
+    return answerStore(storeDir)
+
+# This function calculates the number of matching answers for every pair of respondents.
+# The counts are small integers, so the float32 matrix product is exact.
+# With a missing mask, matching non-responses are not counted
+def getAgreementCounts(answers, missing=None):
+    
+    oneHot = oneHotAnswers(answers, missing)
+    return (oneHot @ oneHot.T).astype(np.int32)
+
+# This function returns the pairs (i < j) of respondents who agree on more than threshold answers,
+# as two arrays sorted by the first and then the second respondent
+def getEdgesAboveThreshold(agreement, threshold):
+    
+    # only look above the diagonal, so that every pair is counted once
+    return np.nonzero(np.triu(agreement > threshold, k=1))
+
+## STREAMING EDGE COMPUTATION ------------------------------------------------------------------
+
+# For large files (e.g. all 68k respondents of the cumulative GSS file) the n*n agreement matrix does
+# not fit in memory. Instead, the rows are processed in blocks of tileSize respondents, and each block
+# is compared to the later respondents one tileSize x tileSize tile at a time. Every tile is
+# thresholded right away, so only the surviving edges are kept, and peak memory depends on the
+# tile size rather than on n*n. Row blocks can be spread across a process pool.
+
+# one-hot answer matrix shared with the worker processes
+workerOneHot = None
+
+# This function hands the one-hot answer matrix to a worker process
+def initEdgeWorker(oneHot):
+    global workerOneHot
+    workerOneHot = oneHot
+
+# This function finds the edges of one row block, tile by tile, and returns them sorted
+# by the first and then the second respondent, along with the number of matching answers of each
+def getBlockEdges(job):
+    
+    blockStart, tileSize, threshold = job
+    oneHot = workerOneHot
+    blockEnd = min(blockStart + tileSize, oneHot.shape[0])
+    firstParts = []
+    secondParts = []
+    countParts = []
+    # compare the block with itself and every later tile
+    for tileStart in range(blockStart, oneHot.shape[0], tileSize):
+        tileEnd = min(tileStart + tileSize, oneHot.shape[0])
+        agreement = oneHot[blockStart:blockEnd] @ oneHot[tileStart:tileEnd].T
+        matches = agreement > threshold
+        if tileStart == blockStart:
+            # only keep pairs above the diagonal, so that every pair is counted once
+            matches = np.triu(matches, k=1)
+        first, second = np.nonzero(matches)
+        firstParts.append((first + blockStart).astype(np.int32))
+        secondParts.append((second + tileStart).astype(np.int32))
+        countParts.append(agreement[first, second].astype(np.int32))
+    first = np.concatenate(firstParts)
+    second = np.concatenate(secondParts)
+    order = np.lexsort((second, first))
+    
+    return first[order], second[order], np.concatenate(countParts)[order]
+
+# This function returns the pairs (i < j) of respondents who agree on more than threshold answers,
+# computed tile by tile, as two int32 arrays sorted by the first and then the second respondent.
+# With withCounts, a third array holds the number of matching answers of every pair.
+# If processes is given, row blocks are processed by a pool of that many workers.
+# If edgeFile is given, the edges are written to it as rows of int32 values while they are
+# found, and the returned arrays are read-only views of that file.
+# With a missing mask, matching non-responses do not count towards agreement
+def getEdgesInTiles(answers, threshold, tileSize=2048, processes=None, edgeFile=None, withCounts=False, missing=None):
+    
+    oneHot = oneHotAnswers(answers, missing)
+    numberOfColumns = 3 if withCounts else 2
+    jobs = [(blockStart, tileSize, threshold) for blockStart in range(0, answers.shape[0], tileSize)]
+    if processes is None:
+        initEdgeWorker(oneHot)
+        blocks = map(getBlockEdges, jobs)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes, initializer=initEdgeWorker, initargs=(oneHot,))
+        # imap keeps the blocks in order, so the edges stay sorted
+        blocks = pool.imap(getBlockEdges, jobs)
+    try:
+        if edgeFile is None:
+            parts = list(zip(*blocks)) if jobs else [[np.empty(0, dtype=np.int32)]] * 3
+            return tuple(np.concatenate(columnParts) for columnParts in parts[:numberOfColumns])
+        with open(edgeFile, "wb") as outputStream:
+            for block in blocks:
+                np.column_stack(block[:numberOfColumns]).tofile(outputStream)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        initEdgeWorker(None)
+    if os.path.getsize(edgeFile) == 0:
+        return (np.empty(0, dtype=np.int32),) * numberOfColumns
+    edges = np.memmap(edgeFile, dtype=np.int32, mode="r").reshape(-1, numberOfColumns)
+    return tuple(edges[:, column] for column in range(numberOfColumns))
+
+## SIGNIFICANCE THRESHOLD ----------------------------------------------------------------------
+
+# This function calculates the edge threshold of an answer matrix from its answer distributions.
+# Two random respondents give the same answer to a question with probability p_q = sum of
+# (share of each answer)^2. The number of matches out of n questions is approximated by a normal
+# distribution with mean n*p and standard deviation sqrt(n*p*(1-p)), where p is the average p_q.
+# An edge needs more matches than one standard deviation above the mean, and as matches are whole
+# numbers, the threshold is the mean plus one standard deviation rounded down.
+# With a missing mask, non-responses never match: the shares are taken over the respondents who
+# answered, and p_q is multiplied by the chance that both respondents answered the question.
+# Returns the threshold, the mean and the standard deviation
+def getSignificanceThreshold(answers, missing=None):
+    
+    numberOfAnswers = answers.shape[1]
+    # probability of a match on every question, from the share of each answer
+    if missing is None:
+        matchProbabilities = np.array([np.sum((np.bincount(column) / len(column)) ** 2) for column in answers.T])
+    else:
+        matchProbabilities = np.array([np.sum((np.bincount(column[~skipped]) / len(column)) ** 2)
+                                       for column, skipped in zip(answers.T, np.asarray(missing).T)])
+    p = matchProbabilities.mean()
+    mean = float(numberOfAnswers * p)
+    standardDeviation = math.sqrt(numberOfAnswers * p * (1 - p))
+    
+    return int(math.floor(mean + standardDeviation)), mean, standardDeviation
+
+# The thresholds of the study for the bundled files, as documented and used for Data_Output.xlsx.
+# The calculated thresholds match them for 1978 and 2008, but come out at 10 instead of 11 for
+# 1988, 1998 and 2018 (mean plus one standard deviation of 10.56, 10.46 and 10.45)
+publishedThresholds = {"GSS1978_reduced.csv": 11,
+                       "GSS1988_reduced.csv": 11,
+                       "GSS1998_reduced.csv": 11,
+                       "GSS2008_reduced.csv": 10,
+                       "GSS2018_reduced.csv": 11}
+
+# This function returns the edge threshold to use for a file. A number is used as it is, and
+# "calculated" calculates it from the file's answers (see getSignificanceThreshold). None uses the
+# published threshold of a bundled file, and calculates it for any other file
+def getFileThreshold(inFile, answers, threshold=None):
+    
+    if threshold is None:
+        threshold = publishedThresholds.get(os.path.basename(inFile), "calculated")
+    if threshold == "calculated":
+        return getSignificanceThreshold(answers)[0]
+    
+    return threshold
+
+## THRESHOLD SWEEPS ----------------------------------------------------------------------------
+
+# This function builds the network of a file for every threshold in thresholds from a single pass
+# over the agreement counts: the edges above the lowest threshold are found once, along with their
+# number of matches, and each network keeps the edges above its own threshold.
+# Returns a dictionary of threshold: network, as NetworkX graphs or csrGraphs depending on backend
+def createNetworksForThresholds(inFile, thresholds, tileSize=2048, processes=None, backend="networkx"):
+    
+    answers = loadAnswerMatrix(inFile)
+    firstNodes, secondNodes, matches = getEdgesInTiles(answers, min(thresholds), tileSize, processes, withCounts=True)
+    networks = {}
+    for threshold in thresholds:
+        # filtering keeps the edges sorted
+        keep = matches > threshold
+        networks[threshold] = graphBackends[backend](answers.shape[0], firstNodes[keep], secondNodes[keep])
+        
+    return networks
+
+# This function returns the link density and global clustering of a file's network for every
+# threshold in thresholds, as lists in the same order
+def sweepThresholds(inFile, thresholds, tileSize=2048, processes=None):
+    
+    networks = createNetworksForThresholds(inFile, thresholds, tileSize, processes, backend="csr")
+    densities = [getDensity(networks[threshold]) for threshold in thresholds]
+    clustering = [getClusteringData(networks[threshold])[0] for threshold in thresholds]
+    
+    return densities, clustering
+
+## BUILDING THE NETWORK ------------------------------------------------------------------------
+
+# This function builds a network of numberOfNodes respondents from the edge arrays in bulk.
+# Nodes are added in the same order in which the original one-pair-at-a-time loop first met
+# them: respondent i when its own row is reached, unless an earlier edge already added it.
+# With the edges sorted, the resulting graph (including node and neighbor order) is identical
+def graphFromEdges(numberOfNodes, firstNodes, secondNodes):
+    
+    outGraph = nx.Graph()
+    # position at which the loop reaches each respondent's own row:
+    # every earlier row adds its own node and all of its edges
+    edgesBefore = np.searchsorted(firstNodes, np.arange(numberOfNodes))
+    firstSeen = np.arange(numberOfNodes) + edgesBefore
+    # position at which each edge is added, and the earliest edge that adds each second node
+    edgePosition = firstNodes + 1 + np.arange(len(firstNodes))
+    np.minimum.at(firstSeen, secondNodes, edgePosition)
+    outGraph.add_nodes_from(np.argsort(firstSeen, kind="stable").tolist())
+    outGraph.add_edges_from(zip(firstNodes.tolist(), secondNodes.tolist()))
+    
+    return outGraph
+
+## CSR NETWORKS --------------------------------------------------------------------------------
+
+# A NetworkX graph stores every edge twice in dictionaries, which takes hundreds of bytes per edge.
+# A csrGraph keeps the same network as two arrays in compressed sparse row (CSR) form: the
+# neighbors of node i are indices[indptr[i]:indptr[i + 1]], in increasing order, with every edge
+# stored in both directions, which takes 4 bytes per edge direction. Nodes are the respondents
+# 0 .. n-1. Density, degrees, V shapes, isolates, components and clustering are computed on the
+# arrays directly (see NETWORK MEASURES); toNetworkX builds the NetworkX graph when an algorithm
+# or a plot needs one. number_of_nodes, number_of_edges and graph work as they do in NetworkX
+
+# This function turns the edges (i < j, sorted) of a network into CSR arrays, indptr and indices
+def getAdjacencyArrays(numberOfNodes, firstNodes, secondNodes):
+    
+    rows = np.concatenate([firstNodes, secondNodes])
+    columns = np.concatenate([secondNodes, firstNodes]).astype(np.int32)
+    order = np.lexsort((columns, rows))
+    indptr = np.zeros(numberOfNodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=numberOfNodes), out=indptr[1:])
+    
+    return indptr, columns[order]
+
+class csrGraph():
+    
+    def __init__(self, indptr, indices):
+        self.indptr = indptr
+        self.indices = indices
+        self.graph = {}
+    
+    # Build the network of numberOfNodes respondents from the edges (i < j) found by getEdgesInTiles
+    @classmethod
+    def fromEdges(cls, numberOfNodes, firstNodes, secondNodes):
+        return cls(*getAdjacencyArrays(numberOfNodes, firstNodes, secondNodes))
+    
+    def number_of_nodes(self):
+        return len(self.indptr) - 1
+    
+    def number_of_edges(self):
+        return len(self.indices) // 2
+    
+    def neighbors(self, node):
+        return self.indices[self.indptr[node]:self.indptr[node + 1]]
+    
+    def degrees(self):
+        return np.diff(self.indptr)
+    
+    # The first node of every stored edge direction, next to indices
+    def rows(self):
+        return np.repeat(np.arange(self.number_of_nodes(), dtype=np.int32), self.degrees())
+    
+    # The edges (i < j) of the network, sorted by the first and then the second node
+    def edges(self):
+        rows = self.rows()
+        upper = self.indices > rows
+        return rows[upper], self.indices[upper]
+    
+    # The NetworkX version of the network, identical to the one graphFromEdges builds.
+    # With isolates False, nodes without any edges are left out. The cached counts of loadNetwork
+    # are not passed on, as the NetworkX graph can be changed
+    def toNetworkX(self, isolates=True):
+        outGraph = graphFromEdges(self.number_of_nodes(), *self.edges())
+        if not isolates:
+            outGraph.remove_nodes_from(np.flatnonzero(self.degrees() == 0).tolist())
+        outGraph.graph.update((name, value) for name, value in self.graph.items() if name not in ("degrees", "triangleCounts"))
+        return outGraph
+
+# The network types the builders can return
+graphBackends = {"networkx": graphFromEdges,
+                 "csr": csrGraph.fromEdges}
+
+# This function loads a network file and creates a NetworkX object based on it.
+# An edge is created when two respondents agree on more than threshold answers.
+# Without a threshold, the published threshold of the file is used; threshold "calculated" (and
+# any file without a published threshold) calculates it from the file's answers based on a normal
+# distribution approximation, see getFileThreshold
+# tileSize, processes and edgeFile control the streaming computation, see getEdgesInTiles
+# backend "csr" returns a csrGraph instead, see CSR NETWORKS
+def createNetworkFromFile(inFile, threshold=None, tileSize=2048, processes=None, edgeFile=None, backend="networkx"):
+
+    # load the answers and count the matching answers of every pair, one tile at a time
+    answers = loadAnswerMatrix(inFile)
+    threshold = getFileThreshold(inFile, answers, threshold)
+    # if the number of matches is greather than threshold, create an edge
+    firstNodes, secondNodes = getEdgesInTiles(answers, threshold, tileSize, processes, edgeFile)
+    
+    # return the final completed network
+    return graphBackends[backend](answers.shape[0], firstNodes, secondNodes)
+
+# This function creates the network of the respondents of the given years from an answer store
+# (see answerStore), using the given questions or all of them. Without skipMissing, non-responses
+# count as answers like they do in createNetworkFromFile; with it, they never count as agreement,
+# and the calculated threshold takes that into account. Nodes are the selected respondents in
+# store order. The other arguments work like they do in createNetworkFromFile
+def createNetworkFromStore(store, years=None, columns=None, threshold=None, skipMissing=True, tileSize=2048,
+                           processes=None, edgeFile=None, backend="networkx"):
+    
+    answers, missing = store.select(years, columns)
+    if not skipMissing:
+        missing = None
+    if threshold is None:
+        threshold = getSignificanceThreshold(answers, missing)[0]
+    firstNodes, secondNodes = getEdgesInTiles(answers, threshold, tileSize, processes, edgeFile, missing=missing)
+    outGraph = graphBackends[backend](answers.shape[0], firstNodes, secondNodes)
+    outGraph.graph["threshold"] = threshold
+    
+    return outGraph
  
     
+## CACHED NETWORKS ----------------------------------------------------------------------------
+
+# Building a network is the most expensive step, so every network built by loadNetwork is stored
+# on disk in a compact .npz file: the edge arrays along with the degree and triangle count of
+# every respondent. The file is named after a hash of the input file contents, the threshold and
+# builderVersion, so editing the CSV or changing the threshold picks a different file, and a
+# changed builder (bump builderVersion) never loads networks built by an older one.
+# loadNetwork hands the stored counts on with csr networks, so their clustering is not counted again.
+
+# directory that holds the cached networks
+graphCacheDir = "graph_cache"
+# version of the network builder, part of every cache key
+builderVersion = 3
+
+# This function returns the cache key of a network: a hash of the input file, threshold and builder version.
+# A threshold of None or "calculated" (see getFileThreshold) is a key of its own, as it only depends on the file
+def getGraphCacheKey(inFile, threshold):
+    
+    fileHash = hashlib.sha256()
+    with open(inFile, "rb") as inputStream:
+        for block in iter(lambda: inputStream.read(1 << 20), b""):
+            fileHash.update(block)
+    keyHash = hashlib.sha256(("%s|%s|%s" % (fileHash.hexdigest(), threshold, builderVersion)).encode())
+    
+    return keyHash.hexdigest()[:32]
+
+# This function returns the stored arrays of a network, building and storing them first if the
+# cache does not have them yet: numberOfNodes, threshold, firstNodes, secondNodes (the sorted
+# edges), and degrees and triangleCounts, indexed by respondent
+def loadGraphArtifacts(inFile, threshold=None, cacheDir=graphCacheDir):
+    
+    cacheFile = os.path.join(cacheDir, getGraphCacheKey(inFile, threshold) + ".npz")
+    if os.path.exists(cacheFile):
+        with np.load(cacheFile) as data:
+            return {name: data[name] for name in data.files}
+    
+    # build the network and count its triangles once
+    answers = loadAnswerMatrix(inFile)
+    fileThreshold = getFileThreshold(inFile, answers, threshold)
+    firstNodes, secondNodes = getEdgesInTiles(answers, fileThreshold)
+    graph = csrGraph.fromEdges(answers.shape[0], firstNodes, secondNodes)
+    degrees = graph.degrees()
+    triangleCounts = getTriangleCounts(graph)
+    artifacts = {"numberOfNodes": np.int64(answers.shape[0]), "threshold": np.int64(fileThreshold), "firstNodes": firstNodes, "secondNodes": secondNodes,
+                 "degrees": degrees, "triangleCounts": triangleCounts}
+    
+    # write to a temporary file first, so that an interrupted write never leaves a broken cache file
+    os.makedirs(cacheDir, exist_ok=True)
+    with open(cacheFile + ".tmp", "wb") as outputStream:
+        np.savez(outputStream, **artifacts)
+    os.replace(cacheFile + ".tmp", cacheFile)
+    
+    return artifacts
+
+# This function returns the network of a file, from the cache when possible.
+# The graph is identical to the one createNetworkFromFile builds with the same backend.
+# With the csr backend, the cached degree and triangle count of every respondent are kept in
+# graph.graph, where getTriangleCounts picks them up
+def loadNetwork(inFile, threshold=None, cacheDir=graphCacheDir, backend="networkx"):
+    
+    artifacts = loadGraphArtifacts(inFile, threshold, cacheDir)
+    graph = graphBackends[backend](int(artifacts["numberOfNodes"]), artifacts["firstNodes"], artifacts["secondNodes"])
+    graph.graph["inFile"] = inFile
+    graph.graph["threshold"] = int(artifacts["threshold"])
+    if isinstance(graph, csrGraph):
+        graph.graph["degrees"] = artifacts["degrees"]
+        graph.graph["triangleCounts"] = artifacts["triangleCounts"]
+    
+    return graph
+
+ 
 ####################################### 2. PROCESSING DATA ###################################### 
     
 ## UTILITY FUNCTIONS FOR CALCULATIONS -----------------------------------------------------------
@@ -107,20 +653,8 @@ def getTriangleCount(graph, node1):
 # This function calculates the Global Clustering of a network
 def getGlobalClustering(graph):
         
-    # v-shape counter:
-    vShapeCount = 0
-    # triangle counter:
-    triangleCount = 0
-    
-    # iterate over all nodes
-    for tempNode in list(graph.nodes()):
-        # increment the v-shapre tracker by the number of v-shapes found
-        vShapeCount = vShapeCount + getVShapeCount(graph, tempNode)
-        # increment the triangle tracker by the number of triangles found
-        triangleCount = triangleCount + getTriangleCount(graph, tempNode)
-        
-    # return the result of calculation as the global clustering value    
-    return triangleCount / vShapeCount
+    # count all triangles and V shapes at once, see getClusteringData below
+    return getClusteringData(graph)[0]
 
 # This function calculates the Local Clustering of a node
 def getLocalClustering(graph, node1):
@@ -136,49 +670,339 @@ def getLocalClustering(graph, node1):
     else:
         return 0
 
+## CLUSTERING ENGINE ----------------------------------------------------------------------------
+
+# The functions above count the triangles of one node at a time, so calculating both the global
+# and every local clustering value counts every triangle several times. The engine below counts
+# the triangles of all nodes at once, as the diagonal of A*A*A / 2 for the adjacency matrix A,
+# computed as the row sums of (A*A) .* A. The results match the functions above exactly.
+
+# This function returns the list of nodes and the edges of a graph as two arrays of positions
+# in that list
+def getEdgeArrays(graph):
+    
+    nodes = list(graph.nodes())
+    position = {node: index for index, node in enumerate(nodes)}
+    edgeCount = graph.number_of_edges()
+    first = np.fromiter((position[u] for u, v in graph.edges()), dtype=np.int64, count=edgeCount)
+    second = np.fromiter((position[v] for u, v in graph.edges()), dtype=np.int64, count=edgeCount)
+    
+    return nodes, first, second
+
+# This function counts the triangles of every node of a network in CSR form (see csrGraph),
+# without self loops
+def countTriangles(indptr, indices):
+    
+    numberOfNodes = len(indptr) - 1
+    if sparse is not None:
+        adjacency = sparse.csr_matrix((np.ones(len(indices), dtype=np.int64), indices, indptr), shape=(numberOfNodes, numberOfNodes))
+        closedPaths = (adjacency @ adjacency).multiply(adjacency).sum(axis=1)
+    else:
+        # without scipy, fall back to a dense product, which needs n*n memory
+        adjacency = np.zeros((numberOfNodes, numberOfNodes), dtype=np.float64)
+        adjacency[np.repeat(np.arange(numberOfNodes), np.diff(indptr)), indices] = 1
+        closedPaths = ((adjacency @ adjacency) * adjacency).sum(axis=1)
+    # every triangle of a node is found once in each direction
+    return np.asarray(closedPaths, dtype=np.int64).ravel() // 2
+
+# This function returns the triangle counts that loadNetwork stored with a csrGraph, or None if
+# there are none. Only csrGraphs carry them, as they cannot be changed after loading; a NetworkX
+# graph can be rewired (e.g. by degree preserving edge swaps), so its triangles are always counted
+def getCachedTriangleCounts(graph):
+    
+    if not isinstance(graph, csrGraph):
+        return None
+    
+    return graph.graph.get("triangleCounts")
+
+# This function counts the triangles of every node, in the order of graph.nodes().
+# Networks from loadNetwork use the counts stored in the graph cache instead
+def getTriangleCounts(graph):
+    
+    triangleCounts = getCachedTriangleCounts(graph)
+    if triangleCounts is not None:
+        return triangleCounts
+    if isinstance(graph, csrGraph):
+        return countTriangles(graph.indptr, graph.indices)
+    nodes, first, second = getEdgeArrays(graph)
+    # self loops do not close any triangles
+    keep = first != second
+    
+    return countTriangles(*getAdjacencyArrays(len(nodes), first[keep], second[keep]))
+
+# This function calculates the clustering of a network in one pass. It returns the global
+# clustering, and arrays with the local clustering, the V shape count and the triangle count
+# of every node, in the order of graph.nodes()
+def getClusteringData(graph):
+    
+    triangleCounts = getTriangleCounts(graph)
+    vShapeCounts = getVShapeCounts(graph)
+    # avoid division by 0: nodes without V shapes have a local clustering of 0
+    localClustering = np.zeros(len(vShapeCounts))
+    np.divide(triangleCounts, vShapeCounts, out=localClustering, where=vShapeCounts > 0)
+    globalClustering = triangleCounts.sum() / vShapeCounts.sum()
+    
+    return globalClustering, localClustering, vShapeCounts, triangleCounts
+
+## NETWORK MEASURES -----------------------------------------------------------------------------
+
+# These functions take either a NetworkX graph or a csrGraph. On a csrGraph they only use its
+# arrays; values per node are in the order of graph.nodes() for NetworkX and by respondent for CSR
+
+# This function returns the link density of a network, the same value as nx.density
+def getDensity(graph):
+    
+    numberOfNodes = graph.number_of_nodes()
+    if numberOfNodes < 2:
+        return 0.0
+    
+    return 2 * graph.number_of_edges() / (numberOfNodes * (numberOfNodes - 1))
+
+# This function returns the degree of every node
+def getDegrees(graph):
+    
+    if isinstance(graph, csrGraph):
+        return graph.degrees()
+    
+    return np.fromiter((degree for node, degree in graph.degree()), dtype=np.int64, count=graph.number_of_nodes())
+
+# This function returns the number of V shapes of every node, degree choose 2
+def getVShapeCounts(graph):
+    
+    degrees = getDegrees(graph)
+    return degrees * (degrees - 1) // 2
+
+# This function returns the degree distribution of a network: the number of nodes with each degree
+def getDegreeDistribution(graph):
+    return np.bincount(getDegrees(graph))
+
+# This function returns the nodes without any edges
+def getIsolates(graph):
+    
+    if isinstance(graph, csrGraph):
+        return np.flatnonzero(graph.degrees() == 0)
+    
+    return np.array(list(nx.isolates(graph)), dtype=np.int64)
+
+# This function finds the connected components of a network. Returns the component of every node,
+# numbered from 0 in the order in which they are first met, and the size of every component.
+# With scipy, the components of a csrGraph are found by a sparse graph search; without it, every
+# node repeatedly takes the lowest label among its neighbors, jumping along the labels to converge quickly
+def getComponents(graph):
+    
+    if not isinstance(graph, csrGraph):
+        graph = csrGraph.fromEdges(graph.number_of_nodes(), *getEdgeArrays(graph)[1:])
+    if sparse is not None:
+        labels = sparse.csgraph.connected_components(
+            sparse.csr_matrix((np.ones(len(graph.indices), dtype=np.int8), graph.indices, graph.indptr),
+                              shape=(graph.number_of_nodes(), graph.number_of_nodes())), directed=False)[1]
+    else:
+        rows = graph.rows()
+        labels = np.arange(graph.number_of_nodes())
+        while True:
+            newLabels = labels.copy()
+            np.minimum.at(newLabels, rows, labels[graph.indices])
+            newLabels = newLabels[newLabels]
+            if np.array_equal(newLabels, labels):
+                break
+            labels = newLabels
+    firstNodes, labels = np.unique(labels, return_index=True, return_inverse=True)[1:]
+    # number the components in the order of their first node
+    rank = np.empty(len(firstNodes), dtype=np.int64)
+    rank[np.argsort(firstNodes)] = np.arange(len(firstNodes))
+    labels = rank[labels.ravel()]
+    
+    return labels, np.bincount(labels)
+
+## INCREMENTAL NETWORKS -----------------------------------------------------------------------
+
+# A network that keeps its triangle, V shape and local clustering counts up to date while
+# respondents are added or removed, for rolling-window and leave-one-out analyses. Adding or
+# removing a respondent compares its answers with every other respondent once (O(n*q)), and only
+# updates the counts of the respondent and its neighbors, since no other triangle changes.
+# Respondents are numbered in the order they are added, starting with the rows of the answer
+# matrix; the numbers of removed respondents are not reused.
+class incrementalNetwork():
+
+    # answers: matrix of answer codes as returned by loadAnswerMatrix; categories: the answer
+    # text of every code of every question, used to code the answers of new respondents
+    def __init__(self, answers, threshold, categories=None):
+        self.threshold = threshold
+        self.categories = categories
+        numberOfNodes = answers.shape[0]
+        # answers are kept in an array with spare rows, which doubles when it is full
+        self.answers = np.zeros((max(2 * numberOfNodes, 16), answers.shape[1]), dtype=answers.dtype)
+        self.answers[:numberOfNodes] = answers
+        self.active = np.zeros(len(self.answers), dtype=bool)
+        self.active[:numberOfNodes] = True
+        self.size = numberOfNodes
+        # build the starting network and count its triangles once
+        firstNodes, secondNodes = getEdgesInTiles(answers, threshold)
+        self.graph = graphFromEdges(numberOfNodes, firstNodes, secondNodes)
+        nodes = np.array(list(self.graph.nodes()), dtype=np.int64)
+        globalClustering, localClustering, vShapeCounts, triangleCounts = getClusteringData(self.graph)
+        self.degrees = np.zeros(len(self.answers), dtype=np.int64)
+        self.triangleCounts = np.zeros(len(self.answers), dtype=np.int64)
+        self.localClustering = np.zeros(len(self.answers))
+        self.degrees[nodes] = [degree for node, degree in self.graph.degree()]
+        self.triangleCounts[nodes] = triangleCounts
+        self.localClustering[nodes] = localClustering
+        # totals over all respondents, as in getGlobalClustering
+        self.totalTriangles = int(triangleCounts.sum())
+        self.totalVShapes = int(vShapeCounts.sum())
+
+    # Create an incremental network from a GSS data file
+    @classmethod
+    def fromFile(cls, inFile, threshold=None):
+        rawAnswers = np.loadtxt(inFile, dtype=str, delimiter=",", skiprows=1, ndmin=2)
+        answers = loadAnswerMatrix(inFile)
+        categories = [list(np.unique(rawAnswers[:, question])) for question in range(rawAnswers.shape[1])]
+        return cls(answers, getFileThreshold(inFile, answers, threshold), categories)
+
+    def __len__(self):
+        return int(self.active.sum())
+
+    # code the answers of a new respondent the same way as loadAnswerMatrix; answers that were
+    # never given before get a new code
+    def encode(self, rawAnswers):
+        if self.categories is None:
+            return np.asarray(rawAnswers, dtype=self.answers.dtype)
+        codes = []
+        for question, answer in enumerate(rawAnswers):
+            answer = str(answer)
+            if answer not in self.categories[question]:
+                self.categories[question].append(answer)
+            codes.append(self.categories[question].index(answer))
+        return np.array(codes, dtype=self.answers.dtype)
+
+    # grow the arrays when no spare row is left
+    def grow(self):
+        for name in ["answers", "active", "degrees", "triangleCounts", "localClustering"]:
+            old = getattr(self, name)
+            new = np.zeros((2 * len(old),) + old.shape[1:], dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    # the local clustering of the given respondents, from their current counts
+    def updateLocalClustering(self, nodes):
+        vShapes = self.degrees[nodes] * (self.degrees[nodes] - 1) // 2
+        values = np.zeros(len(nodes))
+        np.divide(self.triangleCounts[nodes], vShapes, out=values, where=vShapes > 0)
+        self.localClustering[nodes] = values
+
+    # add or remove the triangles that node closes with its neighbors; sign is 1 or -1
+    def updateTriangles(self, node, neighbors, sign):
+        neighborSet = set(neighbors)
+        closed = 0
+        for neighbor in neighbors:
+            # neighbors of this neighbor that are also neighbors of node each close a triangle
+            shared = len(neighborSet.intersection(self.graph[neighbor]))
+            self.triangleCounts[neighbor] += sign * shared
+            closed += shared
+        # every triangle was found from both of its other corners
+        closed //= 2
+        self.triangleCounts[node] = closed if sign > 0 else 0
+        self.totalTriangles += sign * 3 * closed
+
+    # Add a respondent with the given answers (as text or numbers, like the data file)
+    # and return its number
+    def addRespondent(self, rawAnswers):
+        if self.size == len(self.answers):
+            self.grow()
+        node = self.size
+        self.size += 1
+        self.answers[node] = self.encode(rawAnswers)
+        # compare the new answers with every current respondent
+        matches = (self.answers[:node] == self.answers[node]).sum(axis=1)
+        neighbors = np.flatnonzero((matches > self.threshold) & self.active[:node])
+        # every neighbor gains one V shape for each of its current neighbors
+        self.totalVShapes += int(self.degrees[neighbors].sum()) + len(neighbors) * (len(neighbors) - 1) // 2
+        self.degrees[neighbors] += 1
+        self.degrees[node] = len(neighbors)
+        neighborList = neighbors.tolist()
+        self.updateTriangles(node, neighborList, 1)
+        self.graph.add_node(node)
+        self.graph.add_edges_from((node, neighbor) for neighbor in neighborList)
+        self.active[node] = True
+        self.updateLocalClustering(np.append(neighbors, node))
+        return node
+
+    # Remove a respondent by number
+    def removeRespondent(self, node):
+        neighborList = list(self.graph[node])
+        neighbors = np.array(neighborList, dtype=np.int64)
+        self.graph.remove_node(node)
+        self.active[node] = False
+        self.updateTriangles(node, neighborList, -1)
+        self.degrees[neighbors] -= 1
+        # every neighbor loses one V shape for each of its remaining neighbors
+        self.totalVShapes -= int(self.degrees[neighbors].sum()) + len(neighbors) * (len(neighbors) - 1) // 2
+        self.degrees[node] = 0
+        self.localClustering[node] = 0
+        self.updateLocalClustering(neighbors)
+
+    # current global clustering
+    def getGlobalClustering(self):
+        return self.totalTriangles / self.totalVShapes
+
+    # current local clustering of every respondent, in order of their numbers
+    def getLocalClustering(self):
+        return self.localClustering[:self.size][self.active[:self.size]]
+
+    # current dispersion: the standard deviation of the local clustering values
+    def getDispersion(self):
+        return float(np.std(self.getLocalClustering()))
+
 ## UTILITY FUNCTIONS FOR GETTING NODE LISTS -----------------------------------------------------
 
 # This function generates a list of clustering counts
 # Provided through class
 def clistWS(graph):
-    # create a list of nodes
-    allNodes = list(nx.nodes(graph))
-    # create a placeholder to hold the list of local cluster counts
-    cList = []
-    # iterate over the list of nodes and populate our list with the local cluster counts
-    for node in allNodes:
-        cList.append(getLocalClustering(graph, node))
-                
-    # return the list
-    return cList
+    # calculate the local clustering of every node at once, in the order of the node list
+    return getClusteringData(graph)[1].tolist()
 
 # This is a histogram function for handling a list with fractional values
 # Provided through class
+# Bins are numbered from 1 to Nbin, and only bins that hold values are returned
 def histogram(InList, Nbin):
-    xmin = min(InList)  # Find the minimum value of InList
-    xmax = max(InList)  # Find the maximum value of InList
+    values = np.asarray(InList, dtype=float)
+    xmin = values.min()  # Find the minimum value of InList
+    xmax = values.max()  # Find the maximum value of InList
     dx = float(xmax - xmin) / Nbin  # Find bin widths
-    H = {}  # Define the histogram
-    for x in InList:  # Loop over data
-        if x == xmax:  # If x== xmax , store in last bin
-            q = Nbin
-        else:  # Else , find bin
-            q = int((x - xmin) / dx) + 1
-        H[q] = H . get(q, 0) + 1  # Populate histogram
-    xcoord = {}  # Create horizontal coord dictionary
-    for q in H . keys():
-        xcoord[q] = xmin + (q - 1) * dx  # Using left end of bin .
-        # xcoord [q]= xmin +(q -0.5) *dx # This would be mid -bin .
+    # find the bin of every value at once; values equal to xmax are stored in the last bin
+    q = np.full(len(values), Nbin)
+    below = values != xmax
+    q[below] = ((values[below] - xmin) / dx).astype(int) + 1
+    counts = np.bincount(q)  # Populate histogram
+    bins = np.flatnonzero(counts)
+    H = dict(zip(bins.tolist(), counts[bins].tolist()))
+    # Using left end of bin . (xmin +(q -0.5) *dx would be mid -bin .)
+    xcoord = {q: xmin + (q - 1) * dx for q in H}
         
     return (xcoord, H)
 
 
 ## UTILITY FUNCTIONS FOR PLOTTING ------------------------------------------------------------
 
+# This function switches matplotlib to a backend that draws to files only, for batch runs
+# without a display
+def useHeadlessPlots():
+    plt.switch_backend("Agg")
+
+# This function displays the current plot, or saves it to outFile and closes it when one is given
+def showPlot(outFile=None):
+    if outFile is None:
+        plt.show()
+    else:
+        plt.savefig(outFile)
+        plt.close()
+
 # This function plots the histogram of a list with fractional values
-def plotFloatHist(Graph, Nbin):
+# cList can be passed in when the local clustering values are already known
+def plotFloatHist(Graph, Nbin, cList=None, outFile=None):
     # get the clustering list for our Graph
-    cList = clistWS(Graph)
+    if cList is None:
+        cList = clistWS(Graph)
     # retrieve the dictionaries containing x coordinates and the values
     xcoord, H = histogram(cList, Nbin)
     # plot the values
@@ -186,12 +1010,14 @@ def plotFloatHist(Graph, Nbin):
     plt.title("Histogram of Local Clustering counts")
     plt.xlabel("Local Clustering Value")
     plt.ylabel("Occurances")
-    plt.show()
+    showPlot(outFile)
 
-# This function plots log scale version of the histogram function  
-def plotFloatHistLog(Graph, Nbin):
+# This function plots log scale version of the histogram function
+# The plot is saved to outFile instead of displayed when one is given
+def plotFloatHistLog(Graph, Nbin, cList=None, outFile=None):
     # get the clustering list for our Graph
-    cList = clistWS(Graph)
+    if cList is None:
+        cList = clistWS(Graph)
     # retrieve the dictionaries containing x coordinates and the values
     xcoord, H = histogram(cList, Nbin)
     # plot the values
@@ -201,7 +1027,7 @@ def plotFloatHistLog(Graph, Nbin):
     plt.ylabel("Occurances")
     plt.yscale('log')
     #plt.xscale('log')
-    plt.show()  
+    showPlot(outFile)
     
 ################################ 3. GENERATING OUTPUT DATA ####################################
 
@@ -212,11 +1038,10 @@ def generateClusteringData(Graph):
     
     # Generate some temporary variables to store our values and populate them
     # Network link density
-    tempDensity = nx.density(Graph)
-    # Network Global Clustering
-    tempClustering = getGlobalClustering(Graph)
-    # List of local clustering values for every node
-    tempCList = clistWS(Graph)
+    tempDensity = getDensity(Graph)
+    # Network Global Clustering and the list of local clustering values for every node,
+    # from a single count of the triangles
+    tempClustering, tempCList = getClusteringData(Graph)[:2]
     
     # Print out the results
     print("Link Density is %4f" % (tempDensity))
@@ -225,29 +1050,77 @@ def generateClusteringData(Graph):
     print("Standard Deviation is %4f" % (np.std(tempCList)))
     print("Plotting histogram...")
     # Plot the results on a log scale chart
-    plotFloatHistLog(Graph, 40)
+    plotFloatHistLog(Graph, 40, tempCList.tolist())
     
     
+# Community detection algorithms that detectCommunities can use. Each takes a graph and a seed
+# and returns a list of sets of nodes
+communityAlgorithms = {
+    # Clauset-Newman-Moore greedy modularity, the original method
+    "greedy": lambda graph, seed: community.greedy_modularity_communities(graph),
+    # Louvain modularity, much faster on dense networks
+    "louvain": lambda graph, seed: community.louvain_communities(graph, seed=seed),
+    # semi-synchronous label propagation, the fastest but least stable
+    "label_propagation": lambda graph, seed: community.label_propagation_communities(graph),
+}
+
+# This function detects the communities of a network without printing or plotting anything.
+# Disconnected nodes are left out through a view of the network, since we are not interested in
+# communities of size 1; the network itself is not copied or changed. A csrGraph is converted
+# to NetworkX here, without its disconnected nodes, as the algorithms need a NetworkX graph.
+# localClustering can pass in the local clustering values of the network (in node order, as
+# returned by getClusteringData) when they are already known; otherwise they come from
+# getClusteringData, which uses the triangle counts stored with csrGraphs from loadNetwork.
+# Returns a dictionary with the communities (largest first), their number, the Effective Number of
+# Parties, their sizes, the average local clustering of each community and the view used
+def detectCommunities(Graph, algorithm="greedy", localClustering=None, seed=None):
+    
+    # view of the network without the disconnected nodes
+    if isinstance(Graph, csrGraph):
+        connectedGraph = Graph.toNetworkX(isolates=False)
+    else:
+        connectedGraph = Graph.subgraph([node for node, degree in Graph.degree() if degree > 0])
+    communities = sorted(communityAlgorithms[algorithm](connectedGraph, seed), key=len, reverse=True)
+    sizes = np.array([len(com) for com in communities])
+    # The Effective Number of Parties (ENP) is the weighted number of communities:
+    # 1 / SUM OF (EVERY COMMUNITY PROPORTION ) ^ 2
+    enp = 1 / np.sum((sizes / Graph.number_of_nodes()) ** 2) if len(sizes) > 0 else 0.0
+    # the local clustering of a node does not depend on the disconnected nodes,
+    # so the values of the full network can be averaged over each community
+    if localClustering is None:
+        localClustering = getClusteringData(Graph)[1]
+    # the values of a csrGraph are indexed by the nodes themselves
+    if isinstance(Graph, csrGraph):
+        position = range(Graph.number_of_nodes())
+    else:
+        position = {node: index for index, node in enumerate(Graph.nodes())}
+    clustering = [float(np.mean(localClustering[[position[node] for node in com]])) for com in communities]
+    
+    return {"communities": communities, "count": len(communities), "enp": enp, "sizes": sizes,
+            "clustering": clustering, "graph": connectedGraph}
+
 # This function is used to determine the number of communities in a network and plot them.
-def getCommunities(Graph):
-    
-    # Create a temporary network, so that we do not change the original network.
-    tempGraph = copy.deepcopy(Graph)
-    # Remove disconnected nodes from the temporary network - since we are not interested in communities that
-    # are thsoe that are larger than 1
-    tempGraph.remove_nodes_from(list(nx.isolates(tempGraph)))
-    # perform a Clauset-Newman-Moore communitiy detection
-    communities = community.greedy_modularity_communities(tempGraph)
-    print("Number of communities is %4d" % (len(communities)))
-    # Now, let's calculate the Effective Number of Parties (ENP) calculation to get the weighted number of communities
-    # The formula is 1 / SUM OF (EVERY COMMUNITY PROPORTION ) ^ 2
-    # First, calculate the sum. Create a placeholder to store the sum value.
-    communitySum = 0 
-    # Calculate the square of each community proportion of the entire population and add it to the sum variable.
-    for com in communities:
-        communitySum = communitySum + (len(com)/Graph.number_of_nodes())**2
+# Set plot to False to only print the numbers; the results of detectCommunities are returned
+def getCommunities(Graph, algorithm="greedy", plot=True, localClustering=None, seed=None):
+    
+    result = detectCommunities(Graph, algorithm, localClustering, seed)
+    communities = result["communities"]
+    print("Number of communities is %4d" % (result["count"]))
     # print out the resulting ENP
-    print("The Effective Number of Parties (communities) is %4f" % (1/communitySum))
+    print("The Effective Number of Parties (communities) is %4f" % (result["enp"]))
+    for com in range(len(communities)):
+        # for our reference - print out the community size
+        print("Size of the community %4d is %4d" % (com, result["sizes"][com]))
+        # Also, print out the average local clustering for the community
+        print("Average Local Clustering of the community is %4f" % (result["clustering"][com]))
+    if plot:
+        plotCommunities(result["graph"], communities)
+        
+    return result
+
+# This function plots a network with every community in its own color
+# The plot is saved to outFile instead of displayed when one is given
+def plotCommunities(tempGraph, communities, outFile=None):
            
     # suppress matplotlib warnings about random colors
     matplotlib_axes_logger.setLevel('ERROR')
@@ -259,10 +1132,6 @@ def getCommunities(Graph):
     nx.draw(tempGraph, pos, edge_color='k', node_size= 5, width= 0.2)
     # iterate over the node list of the communities
     for com in range(len(communities)):
-        # for our reference - print out the community size
-        print("Size of the community %4d is %4d" % (com, len(communities[com])))
-        # Also, print out the average local clustering for the community
-        print("Average Local Clustering of the community is %4f" % (nx.average_clustering(tempGraph, nodes=communities[com])))
         # since we don't know the number of communities, we can colorize them semi-randomly
         # to make sure that the communities have distinct colors, we limit the number of colors
         # that each subsequent community can pull from. Above 5 communities, we keep generating
@@ -283,14 +1152,164 @@ def getCommunities(Graph):
         nx.draw_networkx_nodes(tempGraph, pos, nodelist=communities[com], node_color=tempColor, node_size= 10)
         
     # display the plot
-    plt.show()
+    showPlot(outFile)
+
+## BATCH REPORT ---------------------------------------------------------------------------------
+
+# This function analyzes the network of a single file for the batch report and returns one row
+# of the report. job is (inFile, threshold, algorithm, seed, plotDir)
+def analyzeNetworkFile(job):
+    
+    inFile, threshold, algorithm, seed, plotDir = job
+    name = os.path.splitext(os.path.basename(inFile))[0]
+    Graph = loadNetwork(inFile, threshold, backend="csr")
+    # all clustering measures come from the triangle counts the csrGraph keeps from the graph cache
+    globalClustering, localClustering = getClusteringData(Graph)[:2]
+    communities = detectCommunities(Graph, algorithm, localClustering, seed)
+    if plotDir is not None:
+        os.makedirs(plotDir, exist_ok=True)
+        plotFloatHistLog(Graph, 40, localClustering.tolist(), os.path.join(plotDir, name + "_clustering.png"))
+        plotCommunities(communities["graph"], communities["communities"], os.path.join(plotDir, name + "_communities.png"))
+    
+    return {"network": name,
+            "file": inFile,
+            "threshold": Graph.graph["threshold"],
+            "nodes": Graph.number_of_nodes(),
+            "edges": Graph.number_of_edges(),
+            "density": getDensity(Graph),
+            "globalClustering": globalClustering,
+            "localClusteringStd": float(np.std(localClustering)),
+            "communities": communities["count"],
+            "enp": communities["enp"],
+            "communitySizes": ";".join(str(size) for size in communities["sizes"])}
+
+# This function builds and analyzes the network of every file in inFiles, each in its own worker
+# process when processes is given, and gathers density, global clustering, the standard deviation
+# of local clustering, ENP and community sizes into one table, one row per file.
+# The table is written to outFile as CSV, or as Parquet when the name ends in .parquet (requires
+# pyarrow). With plotDir, the clustering histogram and community plot of every network are saved
+# there as well. Returns the table
+def runReport(inFiles, outFile="polarization_report.csv", processes=None, threshold=None,
+              algorithm="greedy", seed=0, plotDir=None):
+    
+    jobs = [(inFile, threshold, algorithm, seed, plotDir) for inFile in inFiles]
+    if processes is None:
+        rows = list(map(analyzeNetworkFile, jobs))
+    else:
+        # the workers draw to files only, as they have no display; the calling session keeps its backend
+        with multiprocessing.Pool(processes, initializer=useHeadlessPlots) as pool:
+            rows = pool.map(analyzeNetworkFile, jobs)
+    report = pd.DataFrame(rows)
+    if outFile is not None:
+        if outFile.endswith(".parquet"):
+            report.to_parquet(outFile, index=False)
+        else:
+            report.to_csv(outFile, index=False)
+    
+    return report
+
+## NULL MODEL -----------------------------------------------------------------------------------
+
+# The null model keeps the answer distribution of every question, but shuffles the answers of
+# each question between respondents on its own, which removes any link between the opinions of a
+# respondent. Networks of many shuffled replicates show how much clustering and fracturing would
+# appear by chance alone.
+
+# answer matrix shared with the worker processes
+workerAnswers = None
+
+# This function hands the answer matrix to a worker process
+def initNullWorker(answers):
+    global workerAnswers
+    workerAnswers = answers
+
+# This function shuffles the answers within every question column
+def shuffleAnswers(answers, rng):
+    return rng.permuted(answers, axis=0)
+
+# This function builds the null model network of a file for a given seed
+def createNullNetwork(inFile, seed, threshold=None, backend="networkx"):
+    
+    answers = loadAnswerMatrix(inFile)
+    threshold = getFileThreshold(inFile, answers, threshold)
+    nullAnswers = shuffleAnswers(answers, np.random.default_rng(seed))
+    firstNodes, secondNodes = getEdgesInTiles(nullAnswers, threshold)
+    
+    return graphBackends[backend](answers.shape[0], firstNodes, secondNodes)
+
+# This function builds and analyzes one null model replicate.
+# job is (seed, threshold, algorithm, Nbin); algorithm None skips community detection.
+# Returns the measures of the replicate and its local clustering histogram over Nbin bins from 0 to 1
+def analyzeNullReplicate(job):
+    
+    seed, threshold, algorithm, Nbin = job
+    rng = np.random.default_rng(seed)
+    nullAnswers = shuffleAnswers(workerAnswers, rng)
+    firstNodes, secondNodes = getEdgesInTiles(nullAnswers, threshold)
+    Graph = csrGraph.fromEdges(nullAnswers.shape[0], firstNodes, secondNodes)
+    globalClustering, localClustering = getClusteringData(Graph)[:2]
+    row = {"density": getDensity(Graph), "globalClustering": globalClustering,
+           "localClusteringStd": float(np.std(localClustering))}
+    if algorithm is not None:
+        communities = detectCommunities(Graph, algorithm, localClustering, int(rng.integers(2 ** 31)))
+        row["communities"] = communities["count"]
+        row["enp"] = communities["enp"]
+    
+    return row, np.histogram(localClustering, bins=Nbin, range=(0, 1))[0]
+
+# This function runs the null model of a file for the given number of replicates, in a pool of
+# worker processes when processes is given. Every replicate gets its own seed from seed.
+# algorithm defaults to the one of runReport, so the replicates compare with the report.
+# Returns a table with the measures of every replicate, and an array with the local clustering
+# histogram of every replicate (one row each, Nbin bins from 0 to 1)
+def runNullModel(inFile, replicates=200, threshold=None, processes=None, seed=0, algorithm="greedy", Nbin=40):
+    
+    answers = loadAnswerMatrix(inFile)
+    threshold = getFileThreshold(inFile, answers, threshold)
+    jobs = [(replicateSeed, threshold, algorithm, Nbin) for replicateSeed in np.random.SeedSequence(seed).spawn(replicates)]
+    if processes is None:
+        initNullWorker(answers)
+        results = list(map(analyzeNullReplicate, jobs))
+        initNullWorker(None)
+    else:
+        with multiprocessing.Pool(processes, initializer=initNullWorker, initargs=(answers,)) as pool:
+            results = pool.map(analyzeNullReplicate, jobs)
+    rows, histograms = zip(*results)
+    
+    return pd.DataFrame(list(rows)), np.array(histograms)
+
+# This function returns the mean of values with a percentile bootstrap confidence interval,
+# as (mean, low, high). All resamples are drawn at once
+def bootstrapInterval(values, confidence=0.95, resamples=1000, seed=0):
+    
+    values = np.asarray(values, dtype=float)
+    rng = np.random.default_rng(seed)
+    means = values[rng.integers(0, len(values), size=(resamples, len(values)))].mean(axis=1)
+    tail = (1 - confidence) / 2 * 100
+    low, high = np.percentile(means, [tail, 100 - tail])
+    
+    return values.mean(), low, high
+
+# This function summarizes a null model table: the mean of every measure with its bootstrap
+# confidence interval, one row per measure
+def summarizeNullModel(nullTable, confidence=0.95, resamples=1000, seed=0):
+    
+    rows = [(measure,) + bootstrapInterval(nullTable[measure], confidence, resamples, seed) for measure in nullTable.columns]
+    
+    return pd.DataFrame(rows, columns=["measure", "mean", "low", "high"])
 
 ## MULTI NETWORK INPUT ---------------------------------------------------------------------------
 
    
 # plot a clustering histogram of several networks at once
-def compareClustering(inList):
+# nullHistograms can pass in the local clustering histograms of null model replicates
+# (see runNullModel), which are drawn as their median with the range of the middle 95% as error bars.
+# The networks are then binned on the same edges as the null model (Nbin bins from 0 to 1), so that
+# every point and error bar of a bin share the same position and bin width
+def compareClustering(inList, nullHistograms=None, outFile=None):
 
+    if nullHistograms is not None:
+        nullEdges = np.linspace(0, 1, nullHistograms.shape[1] + 1)
     for i in range(len(inList)):
         
         # We use modulo division to colorize input networks differently
@@ -313,10 +1332,27 @@ def compareClustering(inList):
         
         # get the clustering list for our Graph
         cList = clistWS(inList[i])
-        # retrieve the dictionaries containing x coordinates and the values fillstyle='none',
-        xcoord, H = histogram(cList, 40)
+        if nullHistograms is None:
+            # retrieve the dictionaries containing x coordinates and the values fillstyle='none',
+            xcoord, H = histogram(cList, 40)
+            xValues, yValues = list(xcoord.values()), list(H.values())
+        else:
+            # count the values in the bins of the null model, using the left end of each occupied bin
+            counts = np.histogram(cList, bins=nullEdges)[0]
+            xValues, yValues = nullEdges[:-1][counts > 0], counts[counts > 0]
 
-        plt.plot(list(xcoord.values()), list(H.values()), 'o', markersize = 10,  color=tempColor)
+        plt.plot(xValues, yValues, 'o', markersize = 10,  color=tempColor)
+    
+    legend = ["Random", "1978", "1988", "1998", "2008", "2018"][:len(inList)]
+    if nullHistograms is not None:
+        # bins of the null model histograms, using the left end of each bin
+        xcoord = nullEdges[:-1]
+        low, median, high = np.percentile(nullHistograms, [2.5, 50, 97.5], axis=0)
+        # only draw bins that are occupied, as the Y axis is on a log scale
+        shown = median > 0
+        plt.errorbar(xcoord[shown], median[shown], yerr=[median[shown] - low[shown], high[shown] - median[shown]],
+                     fmt='s', markersize = 5, color='k', capsize=3)
+        legend.append("Null model")
     
     # now we can add some detailed information to the overall plot
     plt.title("Histogram of Local Clustering counts")
@@ -324,46 +1360,81 @@ def compareClustering(inList):
     plt.ylabel("Occurences")
     # change the scale to Log on the Y axis due to the large number of nodes
     plt.yscale('log')
-    plt.legend(["Random", "1978", "1988", "1998", "2008", "2018"], loc=0)
+    plt.legend(legend, loc=0)
     # display the plot
-    plt.show()
+    showPlot(outFile)
     
 
 ############################### 4. MAIN PROGRAM ##############################################
 
 ## GATHER DATA --------------------------------------------------------------------------------
 
-n78 = createNetworkFromFile("GSS1978_reduced.csv")
-n88 = createNetworkFromFile("GSS1988_reduced.csv")
-n98 = createNetworkFromFile("GSS1998_reduced.csv")
-n08 = createNetworkFromFile("GSS2008_reduced.csv")
-n18 = createNetworkFromFile("GSS2018_reduced.csv")
-r1 = createNetworkFromFile("sample_input.csv")
-r2 = createNetworkFromFile("sample_input2.csv")
+# The networks are only loaded when they are first used, e.g. gss_polarization.n78 or
+# getNetwork("n78"), and come from the graph cache after the first run. They are held as
+# csrGraphs; use toNetworkX() for anything that needs a NetworkX graph
+networkFiles = {"n78": "GSS1978_reduced.csv",
+                "n88": "GSS1988_reduced.csv",
+                "n98": "GSS1998_reduced.csv",
+                "n08": "GSS2008_reduced.csv",
+                "n18": "GSS2018_reduced.csv"}
+
+# The random baselines are null model networks of the 1978 answers (see createNullNetwork),
+# given as (file, seed)
+nullNetworks = {"r1": ("GSS1978_reduced.csv", 1),
+                "r2": ("GSS1978_reduced.csv", 2)}
     
-graphList1 = [r1, n78]
-graphList2 = [r1, n78, n88, n98, n08, n18]
+# the survey years, in order
+yearNetworks = ["n78", "n88", "n98", "n08", "n18"]
+
+networkLists = {"graphList1": ["r1", "n78"],
+                "graphList2": ["r1", "n78", "n88", "n98", "n08", "n18"]}
+
+# networks loaded so far
+loadedNetworks = {}
+
+# This function returns a network (e.g. "n78") or list of networks (e.g. "graphList2") by name,
+# loading it on first use
+def getNetwork(name):
+    if name in networkLists:
+        return [getNetwork(listName) for listName in networkLists[name]]
+    if name not in loadedNetworks and name in nullNetworks:
+        loadedNetworks[name] = createNullNetwork(*nullNetworks[name], backend="csr")
+    if name not in loadedNetworks:
+        loadedNetworks[name] = loadNetwork(networkFiles[name], backend="csr")
+    return loadedNetworks[name]
+
+# Module attributes such as n78 and graphList2 are loaded lazily through getNetwork
+def __getattr__(name):
+    if name in networkFiles or name in nullNetworks or name in networkLists:
+        return getNetwork(name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 ## PROCESS THE DATA -----------------------------------------------------------------------
 
-# Uncomment to run it all
+# Running this file writes the report of all years to polarization_report.csv, with the plots
+# of every year saved to the plots folder. Each year is analyzed in its own worker process
+if __name__ == "__main__":
+    runReport([networkFiles[name] for name in yearNetworks], "polarization_report.csv",
+              processes=len(yearNetworks), plotDir="plots")
+
+# Or uncomment to run it all interactively
 """
-generateClusteringData(n78)
-generateClusteringData(n88)
-generateClusteringData(n98)
-generateClusteringData(n08)
-generateClusteringData(n18)
-generateClusteringData(r1)
-
-getCommunities(n78)
-getCommunities(n88)
-getCommunities(n98)
-getCommunities(n08)
-getCommunities(n18)
-getCommunities(r1)
-
-compareClustering(graphList1)
-compareClustering(graphList2)
+generateClusteringData(getNetwork("n78"))
+generateClusteringData(getNetwork("n88"))
+generateClusteringData(getNetwork("n98"))
+generateClusteringData(getNetwork("n08"))
+generateClusteringData(getNetwork("n18"))
+generateClusteringData(getNetwork("r1"))
+
+getCommunities(getNetwork("n78"))
+getCommunities(getNetwork("n88"))
+getCommunities(getNetwork("n98"))
+getCommunities(getNetwork("n08"))
+getCommunities(getNetwork("n18"))
+getCommunities(getNetwork("r1"))
+
+compareClustering(getNetwork("graphList1"))
+compareClustering(getNetwork("graphList2"))
 """
 
 ################################## 5. TESTING #########################################
@@ -395,3 +1466,63 @@ def generateData(Graph):
         nx.draw_networkx_nodes(subgraph1, pos, nodelist=subcommunities[com], node_color=(random.random(), random.random(), random.random()), node_size= 10)
     plt.show()
 
+# This is the original pairwise loop version of createNetworkFromFile, kept to check the faster builder against
+def createNetworkFromFileLoop(inFile):
+
+     # Read in the file specified in the input
+     inputStream = open(inFile, 'r')
+     # Create placeholders for our data
+     lines = []
+     dataset = []
+     outGraph = nx.Graph()
+     
+
+     # create a list containing every line in the file
+     for line in inputStream:
+         lines.append(line.strip())
+          
+     # Stop reading the file
+     inputStream.close()
+     
+     for singleLine in lines[1:]:
+         dataset.append(singleLine.split(","))
+     
+     # process the list of values into a network
+     for lineIterator1 in range(len(dataset)):
+         # we need to add every node, even if it will not be connected
+         outGraph.add_node(lineIterator1)
+         for lineIterator2 in range(lineIterator1+1,len(dataset)):
+             # reset the count of matching answers
+             matches = 0
+             # loop through the answers to find matches
+             for answersIterator in range(len(dataset[lineIterator1])):
+                 if (dataset[lineIterator1][answersIterator] == dataset[lineIterator2][answersIterator]):
+                     # increment match counter
+                     matches = matches + 1
+             # if the number of matches is greather than threshold, create an edge
+             # The threshold is calculated based on a normal distribution approximation,
+             # where the mean is calculated as n*p,
+             # and the standard deviation is calculated as sqrt(n*p*(1-p)), where
+             # n = the number of answers and p = average probability of an answer in a question.
+             # For 1978, 1988, 1998 and 2018, change the number below to 11
+             # For 2008, change the number to 10
+             if matches > 11:
+                 outGraph.add_edge(lineIterator1, lineIterator2)
+         
+     # return the final completed network
+     return outGraph
+
+# This function checks that the fast builder creates the same network as the loop version,
+# and reports the time taken by each
+def compareBuilders(inFile, threshold=11):
+    start = time.perf_counter()
+    loopGraph = createNetworkFromFileLoop(inFile)
+    loopTime = time.perf_counter() - start
+    start = time.perf_counter()
+    fastGraph = createNetworkFromFile(inFile, threshold)
+    fastTime = time.perf_counter() - start
+    sameGraph = (list(loopGraph.nodes()) == list(fastGraph.nodes())
+                 and all(list(loopGraph.neighbors(node)) == list(fastGraph.neighbors(node)) for node in loopGraph))
+    print("Loop builder: %4f s, fast builder: %4f s, speedup %4.1f" % (loopTime, fastTime, loopTime / fastTime))
+    print("Networks are identical: %s" % (sameGraph))
+    return sameGraph